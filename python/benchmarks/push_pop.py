@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+''' Micro benchmark for Canvas.push/pop and line.
+Times the current canvas module and, optionally, any older canvas.py for comparison,
+such as one extracted with `git show <rev>:python/canvas.py`:
+```
+git show <rev>:python/canvas.py > /tmp/canvas_before.py
+python benchmarks/push_pop.py /tmp/canvas_before.py
+```
+Run from the `python` directory.
+'''
+import importlib.util
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import canvas
+
+def load_module(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench(module, n=100000):
+    ''' Returns the time (in microseconds) of a push/pop pair and of a line'''
+    c = module.Canvas(64, 64, recording=False)
+    c.fill(255, 0, 0)
+    c.stroke(0)
+    t_push_pop = timeit.timeit(lambda: (c.push(), c.pop()), number=n)
+    t_line = timeit.timeit(lambda: c.line(0, 0, 10, 10), number=n//10)*10
+    return t_push_pop/n*1e6, t_line/n*1e6
+
+if __name__ == '__main__':
+    modules = [('current', canvas)]
+    if len(sys.argv) > 1:
+        modules.insert(0, (os.path.basename(sys.argv[1]), load_module(sys.argv[1], 'canvas_baseline')))
+    for name, module in modules:
+        t_push_pop, t_line = bench(module)
+        print('%s:' % name)
+        print('  push/pop:  %.3f us' % t_push_pop)
+        print('  line:      %.3f us' % t_line)
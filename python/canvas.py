@@ -88,8 +88,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 import cairo
 import numbers
-import copy
-from math import fmod, pi
+import functools
+import re
+import struct
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from math import cos, pi
 import types
 from PIL import Image
 
@@ -98,39 +104,308 @@ def is_number(x):
 
 
 
-def wrapper(self, fn):
+# Drawing commands that can be stored in a DisplayList, with the type of each argument:
+# 'f' float, 'i' integer (cairo enums), 'o' any other object (kept by reference)
+DISPLAY_LIST_OPS = [
+    ('move_to', 'ff'), ('line_to', 'ff'), ('curve_to', 'ffffff'),
+    ('rel_move_to', 'ff'), ('rel_line_to', 'ff'), ('rel_curve_to', 'ffffff'),
+    ('arc', 'fffff'), ('arc_negative', 'fffff'), ('rectangle', 'ffff'),
+    ('close_path', ''), ('new_path', ''), ('new_sub_path', ''),
+    ('fill', ''), ('fill_preserve', ''), ('stroke', ''), ('stroke_preserve', ''),
+    ('paint', ''), ('paint_with_alpha', 'f'),
+    ('clip', ''), ('clip_preserve', ''), ('reset_clip', ''),
+    ('save', ''), ('restore', ''),
+    ('translate', 'ff'), ('scale', 'ff'), ('rotate', 'f'), ('identity_matrix', ''),
+    ('transform', 'o'), ('set_matrix', 'o'),
+    ('set_source_rgb', 'fff'), ('set_source_rgba', 'ffff'), ('set_source', 'o'),
+    ('set_source_surface', 'off'),
+    ('set_line_width', 'f'), ('set_line_cap', 'i'), ('set_line_join', 'i'),
+    ('set_miter_limit', 'f'), ('set_dash', 'of'), ('set_fill_rule', 'i'),
+    ('set_operator', 'i'), ('set_tolerance', 'f'), ('set_antialias', 'i'),
+    ('select_font_face', 'o'), ('set_font_size', 'f'), ('set_font_face', 'o'),
+    ('set_font_matrix', 'o'), ('set_font_options', 'o'),
+    ('text_path', 'o'), ('show_text', 'o'), ('glyph_path', 'o'), ('show_glyphs', 'o'),
+    ('mask', 'o'), ('mask_surface', 'off'),
+    ('push_group', ''), ('pop_group_to_source', ''),
+    # Generic method call, stores (name, args, kwargs)
+    ('call', 'o'),
+    # Call a function with the context as first argument, stores (func, args)
+    ('apply', 'o'),
+]
+DISPLAY_LIST_OP_INDEX = {name: i for i, (name, spec) in enumerate(DISPLAY_LIST_OPS)}
+OP_CALL = DISPLAY_LIST_OP_INDEX['call']
+OP_APPLY = DISPLAY_LIST_OP_INDEX['apply']
+# Ops whose arguments are all floats can be replayed directly from a slice of the argument buffer
+_OP_FLOAT_ONLY = [set(spec) <= {'f'} for name, spec in DISPLAY_LIST_OPS]
+
+# Context methods that only query state and are not recorded
+def _is_query(name):
+    return (name.startswith(('get_', 'in_', 'has_', 'copy_path', 'copy_clip', 'user_to_', 'device_to_')) or
+            name.endswith('_extents'))
+
+
+class DisplayList:
+    ''' Compact recording of cairo drawing commands.
+    Commands are stored as an array of opcodes together with a float64 argument buffer,
+    other arguments (strings, surfaces, patterns, ...) are kept in a separate list of objects.
+    A display list can be replayed to any cairo context (e.g. a raster, SVG or PDF surface).
+    It also behaves as a (write only) cairo context, e.g. `dl.move_to(0, 0)` records a command.
+    '''
+    def __init__(self):
+        self.ops = array('B')
+        self.args = array('d')
+        self.objs = []
+        # Pixel buffers of the recorded images, returned to the canvas when the frame is dropped
+        self.buffers = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(cairo.Context, name):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.record(name, args, kwargs)
+
+    def clear(self):
+        del self.ops[:]
+        del self.args[:]
+        self.objs.clear()
+
+    def copy(self):
+        dl = DisplayList()
+        dl.ops = array('B', self.ops)
+        dl.args = array('d', self.args)
+        dl.objs = list(self.objs)
+        # The copy shares the recorded images, so their buffers must not be reused anymore
+        self.buffers = []
+        return dl
+
+    @property
+    def nbytes(self):
+        ''' Approximate memory used by the opcode and argument buffers'''
+        return len(self.ops)*self.ops.itemsize + len(self.args)*self.args.itemsize
+
+    def record(self, name, args, kwargs=None):
+        ''' Record a call to the context method `name`'''
+        op = DISPLAY_LIST_OP_INDEX.get(name)
+        if op is None or kwargs or op >= OP_CALL or len(args) != len(DISPLAY_LIST_OPS[op][1]):
+            self.ops.append(OP_CALL)
+            self.objs.append((name, args, kwargs or {}))
+            return
+        self.ops.append(op)
+        spec = DISPLAY_LIST_OPS[op][1]
+        if 'o' in spec:
+            for arg, kind in zip(args, spec):
+                if kind == 'o':
+                    self.objs.append(arg)
+                else:
+                    self.args.append(arg)
+        else:
+            self.args.extend(args)
+
+    def apply(self, func, *args):
+        ''' Record a call to `func(ctx, *args)`, used for bulk drawing operations'''
+        self.ops.append(OP_APPLY)
+        self.objs.append((func, args))
+
+    def replay(self, ctx):
+        ''' Replay all the recorded commands to a cairo context'''
+        funcs = [getattr(ctx, name) if i < OP_CALL else None
+                 for i, (name, spec) in enumerate(DISPLAY_LIST_OPS)]
+        args = self.args.tolist()
+        objs = self.objs
+        i = 0
+        j = 0
+        for op in self.ops:
+            if op == OP_CALL:
+                name, a, kwargs = objs[j]
+                getattr(ctx, name)(*a, **kwargs)
+                j += 1
+                continue
+            if op == OP_APPLY:
+                func, a = objs[j]
+                func(ctx, *a)
+                j += 1
+                continue
+            spec = DISPLAY_LIST_OPS[op][1]
+            if _OP_FLOAT_ONLY[op]:
+                n = len(spec)
+                funcs[op](*args[i:i+n])
+                i += n
+            else:
+                a = []
+                for kind in spec:
+                    if kind == 'o':
+                        a.append(objs[j])
+                        j += 1
+                    else:
+                        a.append(int(args[i]) if kind == 'i' else args[i])
+                        i += 1
+                funcs[op](*a)
+
+
+def _recorded(self, name, fn):
+    op = DISPLAY_LIST_OP_INDEX.get(name)
+    numeric = op is not None and op < OP_CALL and 'o' not in DISPLAY_LIST_OPS[op][1]
+    n = len(DISPLAY_LIST_OPS[op][1]) if op is not None else -1
     def result(*args, **kwargs):
-        res = None
+        res = fn(*args, **kwargs)
         self.dirty = True
-        for ctx in self.ctxs: #[::-1]:
-            res = getattr(ctx, fn)(*args, **kwargs)
+        dl = self.display_list
+        if dl is not None:
+            if numeric and len(args) == n and not kwargs:
+                dl.ops.append(op)
+                dl.args.extend(args)
+            else:
+                dl.record(name, args, kwargs)
         return res
 
     return result
 
 
-class MultiContext:
-    ''' Workaround for TeeSurface not working on Mac (at least)
-    This should enable rendering to multiple surfaces (each with their own context)
+# Operations that modify pixels, and the context method giving their bounds (in user space)
+_DAMAGE_EXTENTS = {'fill': 'fill_extents', 'fill_preserve': 'fill_extents',
+                   'stroke': 'stroke_extents', 'stroke_preserve': 'stroke_extents',
+                   'paint': 'clip_extents', 'paint_with_alpha': 'clip_extents',
+                   'mask': 'clip_extents', 'mask_surface': 'clip_extents',
+                   'show_text': 'clip_extents', 'show_glyphs': 'clip_extents'}
+
+def _damaging(self, fn, extents):
+    def result(*args, **kwargs):
+        self.add_damage(*extents())
+        return fn(*args, **kwargs)
+
+    return result
+
+
+class CanvasContext:
+    ''' Drawing context used by Canvas.
+    Calls are forwarded to a cairo context drawing on the raster surface and, while recording,
+    are also stored in a DisplayList that can later be replayed to vector (SVG/PDF) surfaces.
+    Query methods (e.g. `get_line_width`, `text_extents`) are forwarded to the raster context only.
     '''
     def __init__(self, surf):
         self.surface = surf
         self.dirty = False
-        self.ctxs = [cairo.Context(surf)]
-        for key, value in cairo.Context.__dict__.items( ):
-            if hasattr( value, '__call__' ):
-                self.__dict__[key] = wrapper(self, key)
+        self.ctx = cairo.Context(surf)
+        self.display_list = None
+        self.save_depth = 0
+        self.track_damage = False
+        self.damage = None
+        for key, value in cairo.Context.__dict__.items():
+            if key.startswith('_') or not hasattr(value, '__call__') or key in ['save', 'restore']:
+                continue
+            fn = getattr(self.ctx, key)
+            if _is_query(key):
+                self.__dict__[key] = fn
+            else:
+                self.__dict__[key] = _recorded(self, key, fn)
 
-    def push_context(self, ctx):
-        self.ctxs.append(ctx)
+    def save(self):
+        self.ctx.save()
+        self.save_depth += 1
+        if self.display_list is not None:
+            self.display_list.ops.append(DISPLAY_LIST_OP_INDEX['save'])
+
+    def restore(self):
+        self.ctx.restore()
+        self.save_depth -= 1
+        if self.display_list is not None:
+            self.display_list.ops.append(DISPLAY_LIST_OP_INDEX['restore'])
+
+    def set_damage_tracking(self, enabled):
+        ''' Enable or disable tracking the bounding box of modified pixels (in `damage`).
+        Tracking requires computing the extents of each fill, stroke or paint, so it is disabled by default'''
+        self.track_damage = enabled
+        self.damage = None
+        for name, extents in _DAMAGE_EXTENTS.items():
+            fn = _recorded(self, name, getattr(self.ctx, name))
+            if enabled:
+                fn = _damaging(self, fn, getattr(self.ctx, extents))
+            self.__dict__[name] = fn
+
+    def add_damage(self, x0, y0, x1, y1, device=False):
+        ''' Add a modified rectangle (in user space, or in device space if `device` is True) to `damage`'''
+        if x1 <= x0 or y1 <= y0:
+            return
+        if not device:
+            corners = [self.ctx.user_to_device(x, y) for x, y in [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]]
+            xs = [p[0] for p in corners]
+            ys = [p[1] for p in corners]
+            x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+        d = self.damage
+        if d is not None:
+            x0, y0, x1, y1 = min(x0, d[0]), min(y0, d[1]), max(x1, d[2]), max(y1, d[3])
+        self.damage = (x0, y0, x1, y1)
+
+    def apply(self, func, *args):
+        ''' Call `func(ctx, *args)` on the raster context, recording a single command.
+        Used to build paths in bulk without going through the per-call wrappers'''
+        res = func(self.ctx, *args)
+        self.dirty = True
+        if self.display_list is not None:
+            self.display_list.apply(func, *args)
+        return res
+
+    def begin_recording(self):
+        ''' Start recording to a new display list that inherits the current drawing state'''
+        dl = DisplayList()
+        copy_context_state(self.ctx, dl)
+        # Keep save/restore balanced if recording starts within a save/restore pair
+        for i in range(self.save_depth):
+            dl.save()
+        self.display_list = dl
+        return dl
+
+    def end_recording(self):
+        dl = self.display_list
+        self.display_list = None
+        return dl
+
+
+# Blend modes for `Canvas.blend_mode`
+BLEND_MODES = {
+    "clear": cairo.OPERATOR_CLEAR,
+    "source": cairo.OPERATOR_SOURCE,
+    "over": cairo.OPERATOR_OVER,  # This is the default blend mode
+    "in": cairo.OPERATOR_IN,
+    "out": cairo.OPERATOR_OUT,
+    "atop": cairo.OPERATOR_ATOP,
+    "dest": cairo.OPERATOR_DEST,
+    "dest_over": cairo.OPERATOR_DEST_OVER,
+    "dest_in": cairo.OPERATOR_DEST_IN,
+    "dest_out": cairo.OPERATOR_DEST_OUT,
+    "dest_atop": cairo.OPERATOR_DEST_ATOP,
+    "xor": cairo.OPERATOR_XOR,
+    "add": cairo.OPERATOR_ADD,
+    "saturate": cairo.OPERATOR_SATURATE,
+    "multiply": cairo.OPERATOR_MULTIPLY,
+    "screen": cairo.OPERATOR_SCREEN,
+    "overlay": cairo.OPERATOR_OVERLAY,
+    "darken": cairo.OPERATOR_DARKEN,
+    "lighten": cairo.OPERATOR_LIGHTEN,
+    "color_dodge": cairo.OPERATOR_COLOR_DODGE,
+    "color_burn": cairo.OPERATOR_COLOR_BURN,
+    "hard_light": cairo.OPERATOR_HARD_LIGHT,
+    "soft_light": cairo.OPERATOR_SOFT_LIGHT,
+    "difference": cairo.OPERATOR_DIFFERENCE,
+    "exclusion": cairo.OPERATOR_EXCLUSION,
+    "hsl_hue": cairo.OPERATOR_HSL_HUE,
+    "hsl_saturation": cairo.OPERATOR_HSL_SATURATION,
+    "hsl_color": cairo.OPERATOR_HSL_COLOR,
+    "hsl_luminosity": cairo.OPERATOR_HSL_LUMINOSITY
+}
 
-    def pop_context(self):
-        self.ctxs.pop()
 
 class CanvasState:
-    def __init__(self, c):
-        self.cur_fill = c._convert_rgba([255.0])
-        self.cur_stroke = None
+    ''' Drawing state (fill and stroke colors as RGBA tuples, or None).
+    States are treated as immutable: `push` shares the current state and
+    setting a color replaces the top of the stack with a new state (copy on write)'''
+    __slots__ = ('cur_fill', 'cur_stroke')
+
+    def __init__(self, cur_fill=(1.0, 1.0, 1.0, 1.0), cur_stroke=None):
+        self.cur_fill = cur_fill
+        self.cur_stroke = cur_stroke
 
 
 class Canvas:
@@ -140,12 +415,19 @@ class Canvas:
     param width: int, width of the canvas in pixels
     param height: int, height of the canvas in pixels
     param clear_callback: function, a callback to be called when the canvas is cleared (for internal use mostly)
+    param recording: controls what is recorded for vector (SVG/PDF) export. Can be one of:
+        - `True` or `'frame'`: each call to `background` starts a new recorded frame, and only the
+          last `recording_frames` frames are retained
+        - `'all'`: everything drawn is recorded (memory grows with the number of drawing calls)
+        - `'on_demand'`: nothing is recorded until `request_export` is called
+        - `False`: no recording, `save_svg` and `save_pdf` are not available
+    param recording_frames: int, number of recorded frames retained when recording per frame
     """
-    def __init__(self, width, height, background=(0.0, 0.0, 0.0, 255.0), clear_callback=lambda: None, output_file='', recording=True):
+    def __init__(self, width, height, background=(0.0, 0.0, 0.0, 255.0), clear_callback=lambda: None, output_file='', recording=True, recording_frames=1):
         """ Constructor"""
         # See https://pycairo.readthedocs.io/en/latest/reference/context.html
-        surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        ctx = MultiContext(surf) #cairo.Context(surf)
+        surf = self._create_surface(width, height)
+        ctx = CanvasContext(surf)
 
         # Create SVG surface for saving
         self.color_scale = 255.0
@@ -164,8 +446,9 @@ class Canvas:
         self._height = height
         self.surf = surf
         self.ctx = ctx
+        self.pixels = None
 
-        self.draw_states = [CanvasState(self)]
+        self.draw_states = [CanvasState()]
 
         # self.cur_fill = self._convert_rgba([255.0])
         # self.cur_stroke = None
@@ -187,15 +470,73 @@ class Canvas:
 
         # Utils
         self._cur_point = []
+        # Pixel buffers used to convert numpy images, by size
+        self._staging_buffers = {}
+        # Buffers of recorded frames that were dropped, reused by the following frames
+        self._buffer_pool = {}
+        # Cache for images drawn with `image(..., cache=True)`, created when first used
+        self.image_cache = None
+        # Offscreen layers, see `create_layer`
+        self.layers = []
+        self._accumulation_buffer = None
 
         self.output_file = output_file
-        self.recording_surface = None
-        if output_file or recording:
-            self.recording_surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
-            recording_context = cairo.Context(self.recording_surface)
-            self.ctx.push_context(recording_context)
-        else:
-            print("Not creating recording context")
+        if output_file and not recording:
+            recording = True
+        if recording is True:
+            recording = 'frame'
+        if recording not in [False, None, 'frame', 'all', 'on_demand']:
+            raise ValueError(f"Invalid recording mode: {recording}")
+        self.recording = recording
+        self.display_list = None
+        self.recorded_frames = deque(maxlen=max(1, recording_frames))
+        self._export_requested = False
+        self._export_executor = None
+        self._pending_exports = []
+        if recording in ['frame', 'all']:
+            self._begin_recorded_frame()
+
+    def _create_surface(self, width, height):
+        return cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+
+    def _begin_recorded_frame(self):
+        ''' Start recording a new frame, the recording inherits the current drawing state'''
+        if len(self.recorded_frames) == self.recorded_frames.maxlen:
+            # The oldest frame is dropped, its image buffers can be reused
+            self._release_buffers(self.recorded_frames[0])
+        self.display_list = self.ctx.begin_recording()
+        self.recorded_frames.append(self.display_list)
+
+    def _release_buffers(self, dl):
+        for key, buf in dl.buffers:
+            if key not in self._buffer_pool and len(self._buffer_pool) >= 8:
+                self._buffer_pool.clear()
+            pool = self._buffer_pool.setdefault(key, [])
+            if len(pool) < 8:
+                pool.append(buf)
+        dl.buffers = []
+
+    def _end_recording(self):
+        self.ctx.end_recording()
+        self.display_list = None
+        self._export_requested = False
+
+    @property
+    def recording_surface(self):
+        ''' The current recorded frame as a cairo RecordingSurface (or None if not recording)'''
+        if self.display_list is None:
+            return None
+        surf = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        self.display_list.replay(cairo.Context(surf))
+        return surf
+
+    def request_export(self):
+        ''' Request a vector export when using the `'on_demand'` recording mode.
+        Recording will start at the next call to `background` and will stop once the
+        frame is saved with `save_svg` or `save_pdf`'''
+        if not self.recording:
+            raise ValueError('Canvas was created without recording')
+        self._export_requested = True
 
     def set_color_scale(self, scale):
         """Set color scale, e.g. if we want to specify colors in the `0`-`255` range, scale would be `255`,
@@ -217,14 +558,14 @@ class Canvas:
         return self.draw_states[-1].cur_fill
     @cur_fill.setter
     def cur_fill(self, value):
-        self.draw_states[-1].cur_fill = value
+        self.draw_states[-1] = CanvasState(_color_tuple(value), self.draw_states[-1].cur_stroke)
 
     @property
     def cur_stroke(self):
         return self.draw_states[-1].cur_stroke
     @cur_stroke.setter
     def cur_stroke(self, value):
-        self.draw_states[-1].cur_stroke = value
+        self.draw_states[-1] = CanvasState(self.draw_states[-1].cur_fill, _color_tuple(value))
 
     def get_stroke_or_fill_color(self):
         """
@@ -282,13 +623,13 @@ class Canvas:
         if args[0] is None:
             self.cur_fill = None
         else:
-            self.cur_fill = self._apply_colormode(self._convert_rgba(args))
+            self.cur_fill = self._color(args)
 
     def stroke(self, *args):
         if args[0] is None:
             self.cur_stroke = None
         else:
-            self.cur_stroke = self._apply_colormode(self._convert_rgba(args))
+            self.cur_stroke = self._color(args)
 
     def stroke_weight(self, w):
         """Set the line width"""
@@ -310,43 +651,11 @@ class Canvas:
         self.ctx.set_line_join(joins[join])
 
     def blend_mode(self, mode="over"):
-        blend_modes = {
-            "clear": cairo.OPERATOR_CLEAR,
-            "source": cairo.OPERATOR_SOURCE,
-            "over": cairo.OPERATOR_OVER,  # This is the default blend mode
-            "in": cairo.OPERATOR_IN,
-            "out": cairo.OPERATOR_OUT,
-            "atop": cairo.OPERATOR_ATOP,
-            "dest": cairo.OPERATOR_DEST,
-            "dest_over": cairo.OPERATOR_DEST_OVER,
-            "dest_in": cairo.OPERATOR_DEST_IN,
-            "dest_out": cairo.OPERATOR_DEST_OUT,
-            "dest_atop": cairo.OPERATOR_DEST_ATOP,
-            "xor": cairo.OPERATOR_XOR,
-            "add": cairo.OPERATOR_ADD,
-            "saturate": cairo.OPERATOR_SATURATE,
-            "multiply": cairo.OPERATOR_MULTIPLY,
-            "screen": cairo.OPERATOR_SCREEN,
-            "overlay": cairo.OPERATOR_OVERLAY,
-            "darken": cairo.OPERATOR_DARKEN,
-            "lighten": cairo.OPERATOR_LIGHTEN,
-            "color_dodge": cairo.OPERATOR_COLOR_DODGE,
-            "color_burn": cairo.OPERATOR_COLOR_BURN,
-            "hard_light": cairo.OPERATOR_HARD_LIGHT,
-            "soft_light": cairo.OPERATOR_SOFT_LIGHT,
-            "difference": cairo.OPERATOR_DIFFERENCE,
-            "exclusion": cairo.OPERATOR_EXCLUSION,
-            "hsl_hue": cairo.OPERATOR_HSL_HUE,
-            "hsl_saturation": cairo.OPERATOR_HSL_SATURATION,
-            "hsl_color": cairo.OPERATOR_HSL_COLOR,
-            "hsl_luminosity": cairo.OPERATOR_HSL_LUMINOSITY
-        }
-
         mode = mode.lower()
 
         # Set the blend mode if it exists in the dictionary
-        if mode in blend_modes:
-            self.ctx.set_operator(blend_modes[mode])
+        if mode in BLEND_MODES:
+            self.ctx.set_operator(BLEND_MODES[mode])
         else:
             raise ValueError(f"Invalid blend mode: {mode}")
 
@@ -371,7 +680,8 @@ class Canvas:
 
     def push(self):
         self.ctx.save()
-        self.draw_states.append(copy.deepcopy(self.draw_states[-1]))
+        # States are immutable, so the current one can be shared
+        self.draw_states.append(self.draw_states[-1])
 
     def pop(self):
         self.ctx.restore()
@@ -428,6 +738,8 @@ class Canvas:
         self.ctx.rotate(radians(deg))
 
     def hsv(self, *args):
+        ''' Convert a HSV color to RGB in the current color scale, e.g. `c.hsv(0.5, 1, 1)`.
+        An array of colors with shape `(n, 3)` or `(n, 4)` can also be converted at once'''
         if len(args) > 1:
             return hsv_to_rgb(np.array(args))*self.color_scale
         else:
@@ -651,6 +963,134 @@ class Canvas:
             self.ctx.stroke()
 
 
+    def _convert_colors(self, colors, n):
+        ''' Convert an array of `n` colors with shape (n, 3) or (n, 4) to normalized RGBA rows.
+        Returns None if `colors` is a single color'''
+        if isinstance(colors, str):
+            return None
+        colors = np.asarray(colors, dtype=float)
+        if colors.ndim != 2:
+            return None
+        if len(colors) != n:
+            raise ValueError(f"Expected {n} colors, got {len(colors)}")
+        colors = colors/self.color_scale
+        if colors.shape[1] == 3:
+            colors = np.column_stack([colors, np.ones(n)])
+        if self._color_mode == 'hsv':
+            colors = hsv_to_rgb(colors)
+        return colors
+
+    def _draw_batch(self, build_path, items, fills=None, strokes=None, stroke_only=False):
+        ''' Draw many primitives, `build_path(ctx, items)` adds the primitives to the current path.
+        Items with per-item colors are grouped into runs of consecutive items with equal colors,
+        each run is filled and then stroked as a single path. Within a run all fills are drawn
+        before the strokes, so the outline of an item can appear over the fill of a later overlapping one.
+        With `stroke_only` (lines and points) the fill color is used if no stroke is set, as in `line`'''
+        if self.no_draw: # we are in a begin_shape end_shape pair
+            self.ctx.apply(build_path, items.tolist())
+            return
+        n = len(items)
+        fill_colors = self._convert_colors(fills, n) if fills is not None else None
+        stroke_colors = self._convert_colors(strokes, n) if strokes is not None else None
+        self.push()
+        # All sub-paths have the same orientation, so overlapping items fill their union
+        # (with the even-odd rule overlaps would be left unfilled)
+        self.ctx.set_fill_rule(cairo.FILL_RULE_WINDING)
+        if fills is not None and fill_colors is None:
+            self.fill(*_color_args(fills))
+        if strokes is not None and stroke_colors is None:
+            self.stroke(*_color_args(strokes))
+        if stroke_only:
+            if self.cur_stroke is None and stroke_colors is None:
+                if self.cur_fill is None:
+                    print('No color is set')
+                self.cur_stroke = self.cur_fill
+            self.cur_fill = None
+        if fill_colors is None and stroke_colors is None:
+            self.ctx.apply(build_path, items.tolist())
+            self._fillstroke()
+            self.pop()
+            return
+
+        # Split into runs of consecutive items with equal fill and stroke colors
+        change = np.zeros(max(n - 1, 0), dtype=bool)
+        for colors in (fill_colors, stroke_colors):
+            if colors is not None:
+                change |= np.any(colors[1:] != colors[:-1], axis=1)
+        bounds = [0] + (np.nonzero(change)[0] + 1).tolist() + [n]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            fill = fill_colors[a] if fill_colors is not None else self.cur_fill
+            stroke = stroke_colors[a] if stroke_colors is not None else self.cur_stroke
+            if fill is None and stroke is None:
+                continue
+            self.ctx.apply(build_path, items[a:b].tolist())
+            if fill is not None:
+                self.ctx.set_source_rgba(*fill)
+                if stroke is not None:
+                    self.ctx.fill_preserve()
+                else:
+                    self.ctx.fill()
+            if stroke is not None:
+                self.ctx.set_source_rgba(*stroke)
+                self.ctx.stroke()
+        self.pop()
+
+    def circles(self, centers, radii, fills=None, strokes=None):
+        """Draw many circles in one pass
+
+        Args:
+        centers: an array with shape `(n, 2)` of circle centers
+        radii: a single radius or an array of `n` radii
+        fills: (optional) an array with shape `(n, 3)` or `(n, 4)` of per-circle fill colors, or a single color
+        strokes: (optional) an array with shape `(n, 3)` or `(n, 4)` of per-circle stroke colors, or a single color
+        If the colors are not specified, the current fill and stroke are used.
+        Overlapping circles are filled as their union. When both fills and strokes are drawn,
+        fills of consecutive circles with equal colors are drawn before their strokes.
+        """
+        centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(centers),))
+        self._draw_batch(_circles_path, np.column_stack([centers, radii]), fills, strokes)
+
+    def rects(self, rects, fills=None, strokes=None):
+        """Draw many rectangles in one pass
+
+        Args:
+        rects: an array with shape `(n, 4)`, each row contains `x, y, width, height`,
+        interpreted according to the current rect mode
+        fills, strokes: (optional) per-rectangle colors, see `circles` (which also describes the drawing order)
+        """
+        rects = np.array(rects, dtype=float).reshape(-1, 4)
+        if self._rect_mode == 'center':
+            rects[:, :2] -= rects[:, 2:]/2
+        elif self._rect_mode == 'radius':
+            rects[:, :2] -= rects[:, 2:]
+            rects[:, 2:] *= 2
+        # Negative sizes would flip the orientation of the rectangle, and cancel out overlaps with the winding rule
+        flipped = rects[:, 2:] < 0
+        rects[:, :2] += np.where(flipped, rects[:, 2:], 0)
+        rects[:, 2:] = np.abs(rects[:, 2:])
+        self._draw_batch(_rects_path, rects, fills, strokes)
+
+    def lines(self, segments, strokes=None):
+        """Draw many line segments in one pass
+
+        Args:
+        segments: an array with shape `(n, 4)` (rows `x1, y1, x2, y2`) or `(n, 2, 2)`
+        strokes: (optional) an array with shape `(n, 3)` or `(n, 4)` of per-segment colors, or a single color
+        """
+        segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        self._draw_batch(_segments_path, segments, strokes=strokes, stroke_only=True)
+
+    def points(self, xy, strokes=None):
+        """Draw many points in one pass, the point size is given by the stroke weight
+
+        Args:
+        xy: an array with shape `(n, 2)` of point positions
+        strokes: (optional) an array with shape `(n, 3)` or `(n, 4)` of per-point colors, or a single color
+        """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self._draw_batch(_points_path, xy, strokes=strokes, stroke_only=True)
+
     def clear_segments(self):
         self.curve_segments = []
         self.curve_segment_types = []
@@ -687,28 +1127,20 @@ class Canvas:
             if len(P) < 3:
                 raise ValueError('Insufficient points for spline')
             Cp = cardinal_spline(P, self.tension, close)
-            #c.begin_contour()
-            self.ctx.move_to(*Cp[0])
-            for i in range(0, len(Cp)-1, 3):
-                self.ctx.curve_to(*Cp[i+1], *Cp[i+2], *Cp[i+3])
-            #c.end_contour(close)
+            self.ctx.apply(_bezier_path, [(Cp[0].tolist(), _bezier_rows(Cp))])
         else:
-            #c.begin_contour()
             cur = self.curve_segments[0].pop(0)
             self.ctx.move_to(*cur)
             for seg, type in zip(self.curve_segments, self.curve_segment_types):
+                if not seg:
+                    continue
                 if type=='C':
                     P = [cur] + seg
                     Cp = cardinal_spline(P, self.tension, False)
-                    # for p in Cp:
-                    #     self.ctx.line_to(*p)
-                    for i in range(0, len(Cp)-1, 3):
-                        self.ctx.curve_to(*Cp[i+1], *Cp[i+2], *Cp[i+3])
+                    self.ctx.apply(_curves_to, _bezier_rows(Cp))
                 else:
-                    for p in seg:
-                        self.ctx.line_to(*p)
+                    self.ctx.apply(_lines_to, _as_points(seg))
                 cur = seg[-1]
-            #c.end_contour()
 
         if close:
             self.ctx.close_path()
@@ -836,15 +1268,38 @@ class Canvas:
     #         self.quadratic(*args)
 
     def load_image(self, path):
-        '''Load an image from disk. Currently only supports png! Use external
-        loading into NumPy instead'''
-        if not 'png' in path:
-            print ("Load image only supports PNG files!!!")
-            assert(0)
-        surf = cairo.ImageSurface.create_from_png(path)
-        return surf
-
-    def image(self, img, *args, opacity=1.0):
+        '''Load an image (PNG, JPEG, WebP or any other format supported by PIL) from disk
+        as a cairo surface, see the module level `load_image`'''
+        return load_image(path)
+
+    def _image_to_surface(self, img):
+        ''' Convert a numpy image to a surface (an A8 surface for 2d arrays), reusing a staging buffer
+        for each image size. Recorded images need their own copy of the pixels since the staging buffer is overwritten,
+        they use buffers owned by the recorded frame, which are reused once the frame is dropped from `recorded_frames`'''
+        mask = len(img.shape) == 2
+        key = (img.shape[:2], mask)
+        dl = self.ctx.display_list
+        if dl is not None:
+            pool = self._buffer_pool.get(key)
+            buf = pool.pop() if pool else _staging_buffer(img.shape, mask)
+            dl.buffers.append((key, buf))
+        else:
+            buf = self._staging_buffers.get(key)
+            if buf is None:
+                if len(self._staging_buffers) >= 8:
+                    self._staging_buffers.clear()
+                buf = _staging_buffer(img.shape, mask)
+                self._staging_buffers[key] = buf
+        if mask:
+            return numpy_to_mask_surface(img, out=buf)
+        return numpy_to_surface(img, out=buf)
+
+    def invalidate_image(self, img=None):
+        ''' Remove an image (or all images if `img` is None) from the image cache'''
+        if self.image_cache is not None:
+            self.image_cache.invalidate(img)
+
+    def image(self, img, *args, opacity=1.0, cache=False, version=0, tint=None):
         """Draw an image at position with (optional) size and (optional) opacity
 
         Args:
@@ -857,13 +1312,105 @@ class Canvas:
         if the position is not specified, the original image dimensions will be used
 
         `opacity`: a value between 0 and 1 specifying image opacity.
+        2d arrays are drawn as opaque grayscale images, without expanding them to four channels.
+        `tint`: if True, 2d arrays are instead drawn as masks (e.g. from a segmentation model) tinted with
+        the current fill color. By default boolean arrays and A8 surfaces are tinted, other 2d arrays are not.
+        Tinted masks are drawn in grayscale if no fill is set.
+        `cache`: if True the converted numpy or PIL image is kept in the canvas image cache
+        (`image_cache`), so drawing the same unchanged image again is nearly free.
+        The cache is keyed on the image object: if its pixels are modified in place, either
+        increment `version` or call `invalidate_image`.
 
         """
+        src = img
+        if tint is None:
+            tint = ((type(img) == np.ndarray and img.dtype == bool) or
+                    (isinstance(img, Image.Image) and img.mode == '1') or
+                    (isinstance(img, cairo.ImageSurface) and img.get_format() == cairo.FORMAT_A8))
+        if cache and (isinstance(img, Image.Image) or type(img) == np.ndarray):
+            if self.image_cache is None:
+                self.image_cache = SurfaceCache()
+            img = self.image_cache.get(src, version)
         if isinstance(img, Image.Image):
             img = np.array(img)
         if type(img) == np.ndarray:
-            img = numpy_to_surface(img)
+            img = self._image_to_surface(img)
         self.ctx.save()
+        pos, size = self._image_rect(img, args)
+        if cache and img is not src and (size[0] != img.get_width() or size[1] != img.get_height()):
+            # Use a cached copy pre-scaled to the target size
+            img = self.image_cache.get(src, version, (int(round(size[0])), int(round(size[1]))))
+
+        # Disabling rect mode for images
+        # if self._rect_mode == 'center':
+        #     pos -= size/2
+        # elif self._rect_mode == 'radius':
+        #     pos -= size
+        #     size *= 2
+
+        self.ctx.translate(pos[0], pos[1])
+
+        if size is not None:
+            sx = size[0]/img.get_width()
+            sy = size[1]/img.get_height()
+            self.ctx.scale(sx, sy)
+
+        self.ctx.rectangle(0, 0, img.get_width(), img.get_height())
+        self.ctx.clip()
+        if img.get_format() == cairo.FORMAT_A8:
+            self._paint_mask(img, opacity, tint)
+        else:
+            self.ctx.set_source_surface(img)
+            self.ctx.paint_with_alpha(opacity)
+        self.ctx.restore()
+
+    def _paint_mask(self, mask, opacity, tint):
+        if tint and self.cur_fill is not None:
+            r, g, b, a = self.cur_fill
+            self.ctx.set_source_rgba(r, g, b, a*opacity)
+            self.ctx.mask_surface(mask, 0, 0)
+        else:
+            # White masked over black gives the grayscale image
+            self.ctx.push_group()
+            self.ctx.set_source_rgb(0, 0, 0)
+            self.ctx.paint()
+            self.ctx.set_source_rgb(1, 1, 1)
+            self.ctx.mask_surface(mask, 0, 0)
+            self.ctx.pop_group_to_source()
+            self.ctx.paint_with_alpha(opacity)
+
+    @contextmanager
+    def mask(self, img, *args):
+        """Clip everything drawn inside a `with` block by a mask image, e.g.:
+        ```
+        with c.mask(segmentation):
+            c.image(frame)
+        ```
+        Args:
+        img: The mask. Either a 2d numpy array (uint8 or in the 0-1 range), a PIL image or a
+            pyCairo surface, in which case its alpha channel is used
+        *args: position and size of the mask, in the same formats as for `image`
+        Outside of the mask rectangle everything is clipped.
+        """
+        if isinstance(img, Image.Image):
+            img = np.array(img)
+        if type(img) == np.ndarray:
+            # Not a staging buffer, images drawn inside the block may reuse those
+            img = numpy_to_mask_surface(img) if len(img.shape) == 2 else numpy_to_surface(img)
+        pos, size = self._image_rect(img, args)
+        self.ctx.push_group()
+        try:
+            yield
+        finally:
+            self.ctx.pop_group_to_source()
+            self.ctx.save()
+            self.ctx.translate(pos[0], pos[1])
+            self.ctx.scale(size[0]/img.get_width(), size[1]/img.get_height())
+            self.ctx.mask_surface(img, 0, 0)
+            self.ctx.restore()
+
+    def _image_rect(self, img, args):
+        ''' Position and size of an image drawn with the given `image` arguments'''
         if len(args) == 0:
             pos = np.zeros(2)
             size = [img.get_width(), img.get_height()]
@@ -885,34 +1432,23 @@ class Canvas:
 
         pos = np.array(pos).astype(float)
         size = np.array(size).astype(float)
-
-        # Disabling rect mode for images
-        # if self._rect_mode == 'center':
-        #     pos -= size/2
-        # elif self._rect_mode == 'radius':
-        #     pos -= size
-        #     size *= 2
-
-        self.ctx.translate(pos[0], pos[1])
-
-        if size is not None:
-            sx = size[0]/img.get_width()
-            sy = size[1]/img.get_height()
-            self.ctx.scale(sx, sy)
-
-        self.ctx.set_source_surface(img)
-        self.ctx.paint_with_alpha(opacity)
-        self.ctx.restore()
+        return pos, size
 
     def shape(self, poly_list, closed=False):
         '''Draw a shape represented as a list of polylines, see the ~polyline~
         method for the format of each polyline
         '''
+        polys = [_as_points(P) for P in poly_list]
+        self.ctx.apply(_polylines_path, [P for P in polys if P], closed)
+        self._fillstroke()
 
-        self.begin_shape()
-        for P in poly_list:
-            self.polyline(P, closed=closed)
-        self.end_shape()
+    def splines(self, poly_list, closed=False):
+        '''Draw a list of polylines as smooth cardinal splines (using the current `tension`) in one pass,
+        see the ~polyline~ method for the format of each polyline
+        '''
+        chains = cardinal_splines(poly_list, self.tension, closed)
+        self.ctx.apply(_bezier_path, [(Cp[0].tolist(), _bezier_rows(Cp)) for Cp in chains if len(Cp) > 1], closed)
+        self._fillstroke()
 
     def text(self, pos, text, center=False):
         ''' Draw text at a given position
@@ -920,15 +1456,28 @@ class Canvas:
         Args:
             if center=True the text will be horizontally centered
         '''
+        self.texts([pos], [text], center)
+
+    def texts(self, positions, strings, center=False):
+        ''' Draw many strings in one pass, with the same font and fill.
+        Laid out glyphs are cached (see TextLayoutCache), so drawing the same strings repeatedly is fast.
+
+        Args:
+            positions: a list of positions or an array with shape `(n, 2)`
+            strings: a list of `n` strings
+            if center=True the text will be horizontally centered
+        '''
+        runs = []
+        for (x, y), text in zip(np.asarray(positions, dtype=float).reshape(-1, 2).tolist(), strings):
+            glyphs, extents = text_layout_cache.get(self.ctx, str(text))
+            if center:
+                x_bearing, y_bearing, w, h = extents[:4]
+                x = x - w/2 - x_bearing
+            runs.append((x, y, glyphs))
 
         if self.cur_fill is not None:
             self.ctx.set_source_rgba(*self.cur_fill)
-        if center:
-            (x, y, w, h, dx, dy) = self.ctx.text_extents(text)
-            self.ctx.move_to(pos[0]-w/2-x, pos[1])
-        else:
-            self.ctx.move_to(*pos)
-        self.ctx.text_path(text)
+        self.ctx.apply(_glyphs_path, runs)
         self.ctx.fill()
 
     def polygon(self, *args):
@@ -946,72 +1495,213 @@ class Canvas:
         
         To close the polyline set the named closed argument to `True`, e.g. `c.polyline(points, closed=True)`.
         '''
-        self.ctx.new_sub_path()
-        #self.ctx.new_path()
         if len(args)==1:
             points = args[0]
         else:
             points = args
-        self.ctx.move_to(*points[0])
-        for p in points[1:]:
-            self.ctx.line_to(*p)
-        if closed:
-            self.ctx.close_path()
-
+        points = _as_points(points)
+        if points:
+            self.ctx.apply(_polylines_path, [points], closed)
         self._fillstroke()
 
+    def clear(self):
+        ''' Clear the canvas to transparent'''
+        self.ctx.save()
+        self.ctx.identity_matrix()
+        self.ctx.set_operator(cairo.OPERATOR_CLEAR)
+        self.ctx.paint()
+        self.ctx.restore()
+
+    def create_layer(self, draw=None, static=True, blend='over', opacity=1.0):
+        """Create an offscreen layer (a Layer, a canvas with its own surface and a transparent background)
+        that is composited onto this canvas by `draw_layers`, in order of creation.
+
+        Args:
+        draw: (optional) a function `draw(layer)` that draws the layer contents
+        static: if True, the layer is drawn once and then composited from its surface,
+        until `layer.invalidate()` is called. Otherwise it is cleared and redrawn each time `draw_layers` is called
+        blend: the blend mode used to composite the layer (see `blend_mode`)
+        opacity: layer opacity, between 0 and 1
+        """
+        if blend.lower() not in BLEND_MODES:
+            raise ValueError(f"Invalid blend mode: {blend}")
+        layer = Layer(self.width, self.height, draw, static, blend, opacity)
+        self.layers.append(layer)
+        return layer
+
+    def draw_layers(self):
+        ''' Composite the layers created with `create_layer`, re-rendering only dynamic (or invalidated) layers'''
+        for layer in self.layers:
+            if not layer.visible:
+                continue
+            if layer.draw_fn is not None and (not layer.static or layer.needs_render):
+                layer.render()
+            surf = layer.surf
+            if self.ctx.display_list is not None:
+                # The layer surface changes, record a copy that is kept until the layer is redrawn
+                if layer.snapshot is None:
+                    layer.snapshot = scale_surface(surf, (surf.get_width(), surf.get_height()))
+                surf = layer.snapshot
+            self.ctx.save()
+            self.ctx.identity_matrix()
+            self.ctx.set_operator(BLEND_MODES[layer.blend.lower()])
+            self.ctx.set_source_surface(surf)
+            self.ctx.paint_with_alpha(layer.opacity)
+            self.ctx.restore()
+
+    def accumulation_buffer(self):
+        ''' Returns the float32 accumulation buffer of the canvas (see AccumulationBuffer), created when first used'''
+        if self._accumulation_buffer is None:
+            self._accumulation_buffer = AccumulationBuffer(self)
+        return self._accumulation_buffer
+
     def identity(self):
         self.ctx.identity_matrix()
 
     def background(self, *args):
         ''' Clear the canvas with a given color '''
         # self.clear_callback()
+        if self.recording == 'frame' or (self.recording == 'on_demand' and self._export_requested):
+            self._begin_recorded_frame()
         self.ctx.identity_matrix()
-        self.ctx.set_source_rgba(*self._apply_colormode(self._convert_rgba(args)))
+        self.ctx.set_source_rgba(*self._color(args))
         self.ctx.rectangle(0, 0, self.width, self.height)
         self.ctx.fill()
 
     def get_buffer(self):
         return self.surf.get_data()
 
-    def get_image(self):
-        ''' Get canvas image as a numpy array '''
-        img = np.ndarray (shape=(self.height, self.width, 4), dtype=np.uint8, buffer=self.surf.get_data())[:,:,:3].copy()
-        img = img[:,:,::-1]
-        return img
-
-    def get_image_grayscale(self):
-        ''' Returns the canvas image as a grayscale numpy array (in 0-1 range)'''
-        img = self.get_image()
-        img = np.sum(img, axis=-1)/3
-        return img/255
+    def _pixel_view(self):
+        # View of the surface pixels (BGRA), taking into account the row stride
+        self.surf.flush()
+        return np.ndarray(shape=(self.height, self.width, 4), dtype=np.uint8, buffer=self.surf.get_data(),
+                          strides=(self.surf.get_stride(), 4, 1))
+
+    def load_pixels(self):
+        ''' Returns a writable numpy view of the canvas pixels with shape `(height, width, 4)`.
+        Channels are in BGRA order with premultiplied alpha (the cairo pixel format).
+        Call `update_pixels` once done modifying the pixels'''
+        self.pixels = self._pixel_view()
+        return self.pixels
+
+    def update_pixels(self):
+        ''' Notify the canvas that the pixels returned by `load_pixels` have been modified'''
+        self.surf.mark_dirty()
+        self.ctx.dirty = True
+        if self.ctx.track_damage:
+            self.ctx.add_damage(0, 0, self.width, self.height, device=True)
+
+    def track_damage(self, enabled=True):
+        ''' Enable tracking the region of the canvas modified by drawing (see `get_damage`)'''
+        self.ctx.set_damage_tracking(enabled)
+
+    def get_damage(self, reset=True):
+        ''' Returns the region modified since the last call as a `(x, y, w, h)` tuple of integers,
+        or None if nothing changed. Unless `track_damage` is enabled, the region is the whole canvas
+        if anything was drawn. If `reset` is True, the region is cleared'''
+        if not self.ctx.track_damage:
+            dirty = self.ctx.dirty
+            if reset:
+                self.ctx.dirty = False
+            return (0, 0, self.width, self.height) if dirty else None
+        d = self.ctx.damage
+        if reset:
+            self.ctx.damage = None
+        if d is None:
+            return None
+        # Pad by one pixel to account for antialiasing
+        x0 = max(0, int(np.floor(d[0])) - 1)
+        y0 = max(0, int(np.floor(d[1])) - 1)
+        x1 = min(self.width, int(np.ceil(d[2])) + 1)
+        y1 = min(self.height, int(np.ceil(d[3])) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1-x0, y1-y0)
+
+    def get_damaged_image(self, reset=True):
+        ''' Returns the region modified since the last call (see `get_damage`) and its pixels (RGB)
+        as a `(region, image)` pair, or `(None, None)` if nothing changed'''
+        region = self.get_damage(reset)
+        if region is None:
+            return None, None
+        return region, self.get_image(region=region)
+
+    def get_image(self, out=None, region=None):
+        ''' Get canvas image as a numpy array (RGB).
+        If `out` is specified (a uint8 array with shape `(height, width, 3)`) the image is written into it.
+        If `region` is specified as `(x, y, w, h)`, only that part of the canvas is returned'''
+        rgb = self._pixel_view()[:, :, 2::-1]
+        if region is not None:
+            x, y, w, h = region
+            rgb = rgb[y:y+h, x:x+w]
+        if out is None:
+            return rgb.copy()
+        np.copyto(out, rgb)
+        return out
+
+    def get_image_grayscale(self, out=None, dtype=np.float32):
+        ''' Returns the canvas image as a grayscale numpy array (in 0-1 range).
+        If `out` is specified (a float array with shape `(height, width)`) the image is written into it'''
+        if out is not None:
+            dtype = out.dtype
+        out = np.sum(self._pixel_view()[:, :, :3], axis=-1, dtype=dtype, out=out)
+        out *= 1.0/(3*255)
+        return out
 
     def save_image(self, path):
         ''' Save the canvas to an image'''
         self.surf.write_to_png(path)
 
-    def save_svg(self, path):
-        ''' Save the canvas to an svg file'''
-        if self.recording_surface is None:
+    def _get_recorded_frame(self, frame):
+        if not self.recorded_frames or (self.recording == 'on_demand' and self.display_list is None):
             raise ValueError('No recording surface in canvas')
-        surf = cairo.SVGSurface(path, self.width, self.height)
-        ctx = cairo.Context(surf)
-        ctx.set_source_surface(self.recording_surface)
-        ctx.paint()
-        surf.finish()
-        fix_clip_path(path, path)
-        
+        return self.recorded_frames[frame]
+
+    def save_svg(self, path, frame=-1):
+        ''' Save the canvas to an svg file.
+        `frame` selects one of the retained recorded frames (the last one by default)'''
+        save_display_list(self._get_recorded_frame(frame), path, self.width, self.height, 'svg')
+        if self.recording == 'on_demand':
+            self._end_recording()
+
+    def save_pdf(self, path, frame=-1):
+        ''' Save the canvas to a pdf file.
+        `frame` selects one of the retained recorded frames (the last one by default)'''
+        save_display_list(self._get_recorded_frame(frame), path, self.width, self.height, 'pdf')
+        if self.recording == 'on_demand':
+            self._end_recording()
+
+    def save_async(self, path, frame=-1):
+        ''' Save the canvas to a png, svg or pdf file (depending on the extension of `path`) on a background thread.
+        The pixels or the recorded frame are copied immediately, so drawing can continue while the file is written.
+        Returns a `concurrent.futures.Future`, whose `result()` waits for the file to be written'''
+        if '.svg' in path or '.pdf' in path:
+            dl = self._get_recorded_frame(frame).copy()
+            kind = 'svg' if '.svg' in path else 'pdf'
+            future = self._submit_export(save_display_list, dl, path, self.width, self.height, kind)
+            if self.recording == 'on_demand':
+                self._end_recording()
+        else:
+            pixels = np.array(self._pixel_view())
+            surf = cairo.ImageSurface.create_for_data(pixels, cairo.FORMAT_ARGB32, self.width, self.height)
+            future = self._submit_export(surf.write_to_png, path)
+        return future
+
+    def _submit_export(self, fn, *args):
+        ''' Run an export function on the background export thread'''
+        if self._export_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='canvas-export')
+        future = self._export_executor.submit(fn, *args)
+        self._pending_exports = [f for f in self._pending_exports if not f.done()] + [future]
+        return future
+
+    def wait_exports(self):
+        ''' Wait for all the files saved with `save_async` to be written'''
+        for future in self._pending_exports:
+            future.result()
+        self._pending_exports = []
 
-    def save_pdf(self, path):
-        ''' Save the canvas to an svg file'''
-        if self.recording_surface is None:
-            raise ValueError('No recording surface in canvas')
-        surf = cairo.PDFSurface(path, self.width, self.height)
-        ctx = cairo.Context(surf)
-        ctx.set_source_surface(self.recording_surface)
-        ctx.paint()
-        surf.finish()
-        
     def Image(self):
         return Image.fromarray(self.get_image())
 
@@ -1054,27 +1744,6 @@ class Canvas:
             plt.gca().axis('off')
         plt.show()
 
-    def _convert_html_color(self, html_color):
-        # Remove '#' if present
-        if html_color.startswith('#'):
-            html_color = html_color[1:]
-
-        # Extract RGB or RGBA components
-        if len(html_color) == 6:
-            r = int(html_color[:2], 16) / 255.0
-            g = int(html_color[2:4], 16) / 255.0
-            b = int(html_color[4:6], 16) / 255.0
-            return np.array([r, g, b, 1.0])
-        elif len(html_color) == 8:
-            r = int(html_color[:2], 16) / 255.0
-            g = int(html_color[2:4], 16) / 255.0
-            b = int(html_color[4:6], 16) / 255.0
-            a = int(html_color[6:8], 16) / 255.0
-            return np.array([r, g, b, a])
-        else:
-            raise ValueError("Invalid HTML color format")
-
-
     def _convert_rgb(self, x):
         if len(x)==1:
             if not is_number(x[0]): # array like input
@@ -1086,34 +1755,87 @@ class Canvas:
                 x[1]/self.color_scale,
                 x[2]/self.color_scale)
 
+    def _convert_html_color(self, html_color):
+        return _convert_html_color(html_color)
+
     def _convert_rgba(self, x):
-        if len(x)==1:
-            if type(x[0]) == str:
-                return self._convert_html_color(x[0])
-            elif not is_number(x[0]): # array like input
-                return np.array(x[0])/self.color_scale
-            return (x[0]/self.color_scale,
-                    x[0]/self.color_scale,
-                    x[0]/self.color_scale, 1.0)
-        elif len(x) == 3:
-            return (x[0]/self.color_scale,
-                    x[1]/self.color_scale,
-                    x[2]/self.color_scale, 1.0)
-        elif len(x) == 2:
-            return (x[0]/self.color_scale,
-                    x[0]/self.color_scale,
-                    x[0]/self.color_scale,
-                    x[1]/self.color_scale)
-        return (x[0]/self.color_scale,
-                x[1]/self.color_scale,
-                x[2]/self.color_scale,
-                x[3]/self.color_scale)
+        return _convert_rgba(x, self.color_scale)
+
+    def _color(self, args):
+        ''' Normalized RGBA tuple for color arguments, interned in the color cache when the arguments are hashable'''
+        try:
+            return _cached_color(args, self._color_mode, self.color_scale)
+        except TypeError: # Unhashable arguments, e.g. a list or numpy array
+            return _normalize_color(args, self._color_mode, self.color_scale)
+
+    def color_cache_info(self):
+        ''' Hit/miss statistics of the (module wide) color cache'''
+        return _cached_color.cache_info()
+
+def _convert_html_color(html_color):
+    # Remove '#' if present
+    if html_color.startswith('#'):
+        html_color = html_color[1:]
+
+    # Extract RGB or RGBA components
+    if len(html_color) == 6:
+        r = int(html_color[:2], 16) / 255.0
+        g = int(html_color[2:4], 16) / 255.0
+        b = int(html_color[4:6], 16) / 255.0
+        return np.array([r, g, b, 1.0])
+    elif len(html_color) == 8:
+        r = int(html_color[:2], 16) / 255.0
+        g = int(html_color[2:4], 16) / 255.0
+        b = int(html_color[4:6], 16) / 255.0
+        a = int(html_color[6:8], 16) / 255.0
+        return np.array([r, g, b, a])
+    else:
+        raise ValueError("Invalid HTML color format")
+
+def _convert_rgba(x, scale):
+    if len(x)==1:
+        if type(x[0]) == str:
+            return _convert_html_color(x[0])
+        elif not is_number(x[0]): # array like input
+            return np.array(x[0])/scale
+        return (x[0]/scale,
+                x[0]/scale,
+                x[0]/scale, 1.0)
+    elif len(x) == 3:
+        return (x[0]/scale,
+                x[1]/scale,
+                x[2]/scale, 1.0)
+    elif len(x) == 2:
+        return (x[0]/scale,
+                x[0]/scale,
+                x[0]/scale,
+                x[1]/scale)
+    return (x[0]/scale,
+            x[1]/scale,
+            x[2]/scale,
+            x[3]/scale)
+
+def _normalize_color(args, mode, scale):
+    clr = _convert_rgba(args, scale)
+    if mode == 'hsv':
+        clr = hsv_to_rgb(clr)
+    return _color_tuple(clr)
+
+# Colors specified with fill, stroke and background, keyed on the raw arguments, mode and scale
+@functools.lru_cache(maxsize=1024)
+def _cached_color(args, mode, scale):
+    return _normalize_color(args, mode, scale)
 
 def map(value, start1, stop1, start2, stop2, within_bounds=False):
-    ''' Re-maps a number from one range to another. '''
+    ''' Re-maps a number (or an array of numbers) from one range to another. '''
+    if not is_number(value):
+        value = np.asarray(value, dtype=float)
     t = ((value - start1) / (stop1 - start1))
     if within_bounds:
-        t = max(0.0, min(t, 1.0))
+        if isinstance(t, np.ndarray):
+            t = np.clip(t, 0.0, 1.0)
+        else:
+            t = max(0.0, min(t, 1.0))
     return start2 + (stop2 - start2) * t
 
 def radians(x):
@@ -1125,36 +1847,435 @@ def degrees(x):
     return x * (180.0/np.pi)
 
 
-def numpy_to_surface(arr):
-    ''' Convert numpy array to a pycairo surface'''
-    # Get the shape and data type of the numpy array
+# Perlin noise, following the implementation of p5js noise()
+PERLIN_YWRAPB = 4
+PERLIN_YWRAP = 1 << PERLIN_YWRAPB
+PERLIN_ZWRAPB = 8
+PERLIN_ZWRAP = 1 << PERLIN_ZWRAPB
+PERLIN_SIZE = 4095
+_perlin = None
+_perlin_list = None
+_perlin_octaves = 4
+_perlin_amp_falloff = 0.5
+
+def _set_perlin_table(table):
+    global _perlin, _perlin_list
+    # Extend the table so the lattice neighbours of any wrapped offset can be
+    # read without wrapping them again
+    _perlin = np.concatenate([table, table[:PERLIN_ZWRAP + PERLIN_YWRAP + 2]])
+    # Indexing a list with ints is much faster than a numpy array for single values
+    _perlin_list = _perlin.tolist()
+
+def noise_seed(seed):
+    ''' Set the seed for `noise` (the same seed gives the same values as p5js noiseSeed)'''
+    # Linear congruential generator used by p5js
+    m, a, c = 4294967296, 1664525, 1013904223
+    z = int(seed) & 0xffffffff
+    table = np.empty(PERLIN_SIZE + 1)
+    for i in range(PERLIN_SIZE + 1):
+        z = (a*z + c) % m
+        table[i] = z / m
+    _set_perlin_table(table)
+
+def noise_detail(lod, falloff=None):
+    ''' Set the number of octaves (`lod`) and the amplitude falloff for each octave of `noise`'''
+    global _perlin_octaves, _perlin_amp_falloff
+    if lod > 0:
+        _perlin_octaves = int(lod)
+    if falloff is not None and falloff > 0:
+        _perlin_amp_falloff = falloff
+
+def _noise_octaves(v):
+    ''' Lattice coordinates and cosine weights of one noise coordinate for each octave'''
+    v = np.abs(np.asarray(v, dtype=np.float64))
+    vi = np.floor(v)
+    vf = v - vi
+    vi = vi.astype(np.int64)
+    octaves = []
+    for o in range(_perlin_octaves):
+        octaves.append((vi, 0.5*(1.0 - np.cos(vf*np.pi))))
+        vi = vi << 1
+        vf = vf*2
+        wrap = vf >= 1.0
+        vi = vi + wrap
+        vf = vf - wrap
+    return octaves
+
+def noise(x, y=0, z=0):
+    ''' Perlin noise (as in p5js) at the given coordinates, in the 0-1 range.
+    The coordinates can be numbers or numpy arrays, which are broadcast against each other.
+    E.g. to compute a noise field over a grid at once:
+    ```
+    xs = np.linspace(0, 10, width)
+    ys = np.linspace(0, 10, height)
+    field = noise(xs[np.newaxis, :], ys[:, np.newaxis])
+    ```
+    Lattice coordinates and interpolation weights are computed along each input
+    before broadcasting, so grids built from 1d axes are cheap to evaluate.
+    '''
+    if _perlin is None:
+        _set_perlin_table(np.random.random(PERLIN_SIZE + 1))
+    if is_number(x) and is_number(y) and is_number(z):
+        return _noise_scalar(float(x), float(y), float(z))
+    perlin = _perlin
+    r = 0.0
+    ampl = 0.5
+    for (xi, rxf), (yi, ryf), (zi, rzf) in zip(_noise_octaves(x), _noise_octaves(y), _noise_octaves(z)):
+        of = (xi + (yi << PERLIN_YWRAPB) + (zi << PERLIN_ZWRAPB)) & PERLIN_SIZE
+        n1 = perlin[of]
+        n1 = n1 + rxf*(perlin[of + 1] - n1)
+        n2 = perlin[of + PERLIN_YWRAP]
+        n2 = n2 + rxf*(perlin[of + PERLIN_YWRAP + 1] - n2)
+        n1 = n1 + ryf*(n2 - n1)
+
+        of = of + PERLIN_ZWRAP
+        n2 = perlin[of]
+        n2 = n2 + rxf*(perlin[of + 1] - n2)
+        n3 = perlin[of + PERLIN_YWRAP]
+        n3 = n3 + rxf*(perlin[of + PERLIN_YWRAP + 1] - n3)
+        n2 = n2 + ryf*(n3 - n2)
+
+        n1 = n1 + rzf*(n2 - n1)
+        r = r + n1*ampl
+        ampl *= _perlin_amp_falloff
+    return r
+
+def _noise_scalar(x, y, z):
+    ''' `noise` for single values, in plain Python'''
+    perlin = _perlin_list
+    x, y, z = abs(x), abs(y), abs(z)
+    xi, yi, zi = int(x), int(y), int(z)
+    xf, yf, zf = x - xi, y - yi, z - zi
+    r = 0.0
+    ampl = 0.5
+    for o in range(_perlin_octaves):
+        of = (xi + (yi << PERLIN_YWRAPB) + (zi << PERLIN_ZWRAPB)) & PERLIN_SIZE
+        rxf = 0.5*(1.0 - cos(xf*pi))
+        ryf = 0.5*(1.0 - cos(yf*pi))
+
+        n1 = perlin[of]
+        n1 += rxf*(perlin[of + 1] - n1)
+        n2 = perlin[of + PERLIN_YWRAP]
+        n2 += rxf*(perlin[of + PERLIN_YWRAP + 1] - n2)
+        n1 += ryf*(n2 - n1)
+
+        of += PERLIN_ZWRAP
+        n2 = perlin[of]
+        n2 += rxf*(perlin[of + 1] - n2)
+        n3 = perlin[of + PERLIN_YWRAP]
+        n3 += rxf*(perlin[of + PERLIN_YWRAP + 1] - n3)
+        n2 += ryf*(n3 - n2)
+
+        n1 += 0.5*(1.0 - cos(zf*pi))*(n2 - n1)
+        r += n1*ampl
+        ampl *= _perlin_amp_falloff
+
+        # Next octave, doubling the frequency
+        xi <<= 1
+        xf *= 2
+        yi <<= 1
+        yf *= 2
+        zi <<= 1
+        zf *= 2
+        if xf >= 1.0:
+            xi += 1
+            xf -= 1
+        if yf >= 1.0:
+            yi += 1
+            yf -= 1
+        if zf >= 1.0:
+            zi += 1
+            zf -= 1
+    return r
+
+
+def noise_grid(xs, ys, z=0):
+    ''' Perlin noise (as in p5js) over the grid spanned by the 1d coordinate arrays `xs` and `ys`
+    at depth `z`, returned as an array with shape (len(ys), len(xs)).
+    Equivalent to `noise(xs[np.newaxis, :], ys[:, np.newaxis], z)`, but much faster since
+    the noise table is only read once per lattice row and column, e.g. for a flow field:
+    ```
+    field = noise_grid(np.arange(width)*0.01, np.arange(height)*0.01, frame_count*0.01)
+    ```
+    '''
+    if _perlin is None:
+        _set_perlin_table(np.random.random(PERLIN_SIZE + 1))
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+    perlin = _perlin
+    h = len(ys)
+    r = np.zeros((h, len(xs)))
+    a = b = None
+    # Octaves touching few lattice rows are interpolated along y with a single
+    # matrix product, the others by gathering the rows for the full grid
+    weights, tables = [], []
+    ampl = 0.5
+    for (xi, rxf), (yi, ryf), (zi, rzf) in zip(_noise_octaves(xs), _noise_octaves(ys), _noise_octaves(z)):
+        # Lattice rows touched by the grid and where each row of the grid falls in them
+        rows = np.unique(np.concatenate([yi, yi + 1]))
+        y0 = np.searchsorted(rows, yi)
+        y1 = np.searchsorted(rows, yi + 1)
+        # Noise interpolated along x and z for each lattice row
+        of = (xi[np.newaxis, :] + (rows[:, np.newaxis] << PERLIN_YWRAPB) + (zi << PERLIN_ZWRAPB)) & PERLIN_SIZE
+        n1 = perlin[of]
+        n1 = n1 + rxf*(perlin[of + 1] - n1)
+        of += PERLIN_ZWRAP
+        n2 = perlin[of]
+        n2 = n2 + rxf*(perlin[of + 1] - n2)
+        n1 += rzf*(n2 - n1)
+        # Interpolate along y
+        if len(rows) <= 256:
+            w = np.zeros((h, len(rows)))
+            w[np.arange(h), y0] = (1.0 - ryf)*ampl
+            w[np.arange(h), y1] = ryf*ampl
+            weights.append(w)
+            tables.append(n1)
+        else:
+            if a is None:
+                a, b = np.empty_like(r), np.empty_like(r)
+            np.take(n1, y0, axis=0, out=a)
+            np.take(n1, y1, axis=0, out=b)
+            b -= a
+            b *= (ryf*ampl)[:, np.newaxis]
+            a *= ampl
+            r += a
+            r += b
+        ampl *= _perlin_amp_falloff
+    if weights:
+        r += np.concatenate(weights, axis=1) @ np.concatenate(tables, axis=0)
+    return r
+
+
+def numpy_to_surface(arr, out=None):
+    ''' Convert numpy array to a pycairo surface.
+    Pixels are written directly in the (BGRA) layout used by cairo. If `out` is specified
+    (a C-contiguous uint8 array with shape `(h, w, 4)`) it is used as the pixel buffer of the surface,
+    otherwise a new buffer is allocated. Float images are assumed to be in the 0-1 range'''
+    h, w = arr.shape[:2]
+    if out is None:
+        out = np.empty((h, w, 4), dtype=np.uint8)
     if len(arr.shape) == 2:
-        if arr.dtype == np.uint8:
-            arr = np.dstack([arr, arr, arr, (np.ones(arr.shape)*255).astype(np.uint8)])
+        # Grayscale, broadcast to the three color channels
+        arr = arr[:, :, np.newaxis]
+        bgr = arr
+    else:
+        bgr = arr[:, :, 2::-1]
+    if arr.dtype == np.uint8:
+        out[:, :, :3] = bgr
+        if arr.shape[2] == 4:
+            out[:, :, 3] = arr[:, :, 3]
         else:
-            # Assume grayscale 0-1 image
-            arr = np.dstack([arr, arr, arr, np.ones(arr.shape)])
-            arr = (arr * 255).astype(np.uint8)
+            out[:, :, 3] = 255
     else:
-        if arr.shape[2] == 3:
-            #pdb.set_trace()
-            if arr.dtype == np.uint8:
-                arr = np.dstack([arr, np.ones(arr.shape[:2], dtype=np.uint8)*255])
-            else:
-                arr = np.dstack([arr, np.ones(arr.shape[:2])])
-                arr = (arr * 255).astype(np.uint8)
+        # Scale and convert in one pass, without a float temporary of the whole image
+        np.multiply(bgr, 255, out=out[:, :, :3], casting='unsafe')
+        if arr.shape[2] == 4:
+            np.multiply(arr[:, :, 3], 255, out=out[:, :, 3], casting='unsafe')
         else:
-            if arr.dtype != np.uint8:
-                arr = (arr * 255).astype(np.uint8)
+            out[:, :, 3] = 255
 
-    arr = arr.copy(order='C') # must be "C-contiguous"
-    arr[:, :, :3] = arr[:, :, ::-1][:,:,1:]
     surf = cairo.ImageSurface.create_for_data(
-        arr, cairo.FORMAT_ARGB32, arr.shape[1], arr.shape[0])
+        out, cairo.FORMAT_ARGB32, w, h)
 
     return surf
 
 
+def _staging_buffer(shape, mask):
+    ''' Pixel buffer for converting an image with the given shape, see `numpy_to_surface` and `numpy_to_mask_surface`'''
+    if mask:
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8, shape[1])
+        return np.empty((shape[0], stride), dtype=np.uint8)
+    return np.empty((shape[0], shape[1], 4), dtype=np.uint8)
+
+def numpy_to_mask_surface(arr, out=None):
+    ''' Convert a 2d numpy array to a pycairo A8 (alpha only) surface, e.g. to draw masks
+    without expanding them to four channels. If `out` is specified (a C-contiguous uint8 array with shape
+    `(h, stride)`, with the A8 stride for the image width) it is used as the pixel buffer of the surface,
+    otherwise a new buffer is allocated. Float (and boolean) images are assumed to be in the 0-1 range'''
+    h, w = arr.shape[:2]
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8, w)
+    if out is None:
+        out = np.empty((h, stride), dtype=np.uint8)
+    if arr.dtype == np.uint8:
+        out[:, :w] = arr
+    else:
+        np.multiply(arr, 255, out=out[:, :w], casting='unsafe')
+    return cairo.ImageSurface.create_for_data(out, cairo.FORMAT_A8, w, h, stride)
+
+
+class SurfaceCache:
+    ''' LRU cache of surfaces converted from numpy or PIL images, bounded by a memory budget (in bytes).
+    Entries are keyed on the identity of the image object, a version number and, optionally,
+    a target size for which a pre-scaled copy is kept. Entries are dropped when the image is garbage collected.
+    At most one pre-scaled copy is kept for each image, and only once the same size is requested twice in a row,
+    so images drawn at animated sizes are scaled when drawn instead of filling the cache.
+    '''
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # Last target size requested for each image
+        self.sizes = {}
+
+    def get(self, img, version=0, size=None):
+        ''' Get the surface for an image, converting (and scaling to `size=(w, h)` if specified) if necessary.
+        If the size changed since the last request for the image, the unscaled surface is returned'''
+        key = (id(img), version, size)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is img:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if size is not None:
+            if self.sizes.get((id(img), version)) != size:
+                self.sizes[(id(img), version)] = size
+                return self.get(img, version)
+            # Replace the copy scaled to the previous size
+            for k in [k for k in self.entries if k[0] == id(img) and k[1] == version and k[2] is not None]:
+                self.nbytes -= self.entries.pop(k)[2]
+        self.misses += 1
+        if size is None:
+            arr = np.array(img) if isinstance(img, Image.Image) else img
+            surf = numpy_to_mask_surface(arr) if len(arr.shape) == 2 else numpy_to_surface(arr)
+        else:
+            surf = scale_surface(self.get(img, version), size)
+        try:
+            ref = weakref.ref(img, lambda ref, i=id(img): self._drop(i))
+        except TypeError: # Object does not support weak references, do not cache
+            return surf
+        self._drop(id(img), version) # Old versions of the image are stale
+        nbytes = surf.get_stride()*surf.get_height()
+        self.entries[key] = (ref, surf, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            k, (ref, s, n) = self.entries.popitem(last=False)
+            self.nbytes -= n
+        return surf
+
+    def _drop(self, obj_id, keep_version=None):
+        for key in [k for k in self.entries if k[0] == obj_id and k[1] != keep_version]:
+            self.nbytes -= self.entries.pop(key)[2]
+        for key in [k for k in self.sizes if k[0] == obj_id and k[1] != keep_version]:
+            del self.sizes[key]
+
+    def invalidate(self, img=None):
+        ''' Remove all entries for an image, or clear the cache if `img` is None'''
+        if img is None:
+            self.entries.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+        else:
+            self._drop(id(img))
+
+
+def scale_surface(surf, size):
+    ''' Returns a copy of an image surface resampled to `size=(w, h)`'''
+    w, h = size
+    res = cairo.ImageSurface(surf.get_format(), max(1, w), max(1, h))
+    ctx = cairo.Context(res)
+    ctx.scale(w/surf.get_width(), h/surf.get_height())
+    ctx.set_source_surface(surf)
+    ctx.get_source().set_filter(cairo.FILTER_GOOD)
+    ctx.set_operator(cairo.OPERATOR_SOURCE)
+    ctx.paint()
+    res.flush()
+    return res
+
+
+class ImageFileCache:
+    ''' LRU cache of image files decoded into cairo surfaces, bounded by a memory budget (in bytes).
+    Entries are keyed on the file path and modification time, so edited files are decoded again.
+    The cache can be used from several threads (see `load_images`).
+    '''
+    def __init__(self, max_bytes=512*1024*1024):
+        import threading
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        ''' Get the surface for an image file, decoding it if necessary'''
+        import os
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        surf = decode_image_file(path)
+        nbytes = surf.get_stride()*surf.get_height()
+        with self.lock:
+            # Drop older versions of the file
+            for k in [k for k in self.entries if k[0] == path and k != key]:
+                self.nbytes -= self.entries.pop(k)[1]
+            if key not in self.entries:
+                self.nbytes += nbytes
+            self.entries[key] = (surf, nbytes)
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                k, (s, n) = self.entries.popitem(last=False)
+                self.nbytes -= n
+        return surf
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+image_file_cache = ImageFileCache()
+
+def decode_image_file(path):
+    ''' Decode an image file (in any format supported by PIL) into a new cairo surface,
+    converting directly to the premultiplied BGRA layout used by cairo'''
+    im = Image.open(path)
+    if im.mode.startswith('I'):
+        # 16 (or 32) bit grayscale, PIL would clip the values when converting to 8 bits
+        arr = (np.clip(np.asarray(im), 0, 65535) >> 8).astype(np.uint8)[:, :, np.newaxis]
+    elif im.mode == 'F':
+        # Float grayscale, assumed to be in the 0-1 range
+        arr = (np.clip(np.asarray(im), 0, 1)*255 + 0.5).astype(np.uint8)[:, :, np.newaxis]
+    else:
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if ('A' in im.mode or 'transparency' in im.info) else 'RGB')
+        arr = np.asarray(im)
+    h, w = arr.shape[:2]
+    out = np.empty((h, w, 4), dtype=np.uint8)
+    out[:, :, :3] = arr[:, :, 2::-1]
+    if arr.shape[2] == 4:
+        alpha = arr[:, :, 3]
+        out[:, :, 3] = alpha
+        if alpha.min() < 255:
+            # Premultiply color by alpha (rounded)
+            rgb = out[:, :, :3].astype(np.uint16)
+            rgb *= alpha[:, :, np.newaxis]
+            rgb += 127
+            rgb //= 255
+            out[:, :, :3] = rgb
+    else:
+        out[:, :, 3] = 255
+    return cairo.ImageSurface.create_for_data(out, cairo.FORMAT_ARGB32, w, h)
+
+def load_image(path):
+    ''' Load an image file (PNG, JPEG, WebP or any other format supported by PIL) as a cairo surface.
+    Decoded images are kept in `image_file_cache`, so loading the same unchanged file again does not decode it.
+    The returned surface is shared by all loads of the file and should not be drawn into'''
+    return image_file_cache.get(path)
+
+def load_images(paths, max_workers=None):
+    ''' Load several image files in parallel with a thread pool (see `load_image`), e.g. to preload a dataset.
+    Returns a list of surfaces in the same order as `paths`'''
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(load_image, paths))
+
+
 def show_image(im, size=None, title='', cmap='gray'):
     ''' Display a (numpy) image'''
     import matplotlib.pyplot as plt
@@ -1191,35 +2312,26 @@ def show_images(images, ncols, size=None, title='', cmap='gray'):
 
 
 def hsv_to_rgb(hsva):
-    h, s, v = hsva[:3]
-    a = 1
-    if len(hsva) > 3:
-        a = hsva[3]
-
-    if s == 0.0:
-        r = g = b = v
-    else:
-        h = fmod(h, 1) / (60.0 / 360.0)
-        i = int(h)
-        f = h - i
-        p = v * (1.0 - s)
-        q = v * (1.0 - s * f)
-        t = v * (1.0 - s * (1.0 - f))
-
-        if i == 0:
-            r, g, b = v, t, p
-        elif i == 1:
-            r, g, b = q, v, p
-        elif i == 2:
-            r, g, b = p, v, t
-        elif i == 3:
-            r, g, b = p, q, v
-        elif i == 4:
-            r, g, b = t, p, v
-        else:
-            r, g, b = v, p, q
-
-    return np.array([r,g,b,a])[:len(hsva)]
+    ''' Convert HSV(A) colors (all components in the 0-1 range) to RGB(A).
+    Accepts a single color or an array of colors with shape `(..., 3)` or `(..., 4)`,
+    and returns an array with the same shape'''
+    hsva = np.asarray(hsva, dtype=float)
+    h, s, v = hsva[..., 0], hsva[..., 1], hsva[..., 2]
+    h = np.fmod(h, 1) / (60.0 / 360.0)
+    i = h.astype(int)
+    f = h - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    # Note that when s == 0, p = q = t = v
+    sectors = [i == 0, i == 1, i == 2, i == 3, i == 4]
+    rgba = np.empty(hsva.shape)
+    rgba[..., 0] = np.select(sectors, [v, q, p, p, t], v)
+    rgba[..., 1] = np.select(sectors, [t, v, v, q, p], p)
+    rgba[..., 2] = np.select(sectors, [p, p, t, v, v], q)
+    if hsva.shape[-1] > 3:
+        rgba[..., 3] = hsva[..., 3]
+    return rgba
 
 
 class VideoInput:
@@ -1230,8 +2342,28 @@ class VideoInput:
     param name: Either an integer indicating the device number, or a string indicating the path of a video file
     param size: A tuple indicating the desired size of the video frames (width, height)
     param resize_mode: A string indicating the desired resize mode. Can be 'crop' or 'stretch'
+    param threaded: If True, frames are captured and resized on a background thread and `read`
+        returns the newest frame without waiting for the camera
+    param interpolation: Interpolation used for resizing, one of 'nearest', 'linear', 'cubic', 'area',
+        'lanczos' (or an OpenCV `INTER_` constant)
+    param num_buffers: Number of output buffers frames are written into in turn (at least 3 in threaded mode)
+    param cache_frames: If True and `name` is a video file, the clip is decoded (and resized) once into
+        a memory mapped frame store shared through `video_frame_cache`. Frames are then read
+        without decoding, and can be accessed at random with `frame(i)`, `seek(i)` and `speed`
+
+    Frames are written into a small pool of reused buffers, so a frame returned by `read` is
+    overwritten after `num_buffers - 1` further frames. Copy it if it needs to be kept longer.
+    Frames read from the frame cache are read-only views and are never overwritten.
+
+    With `cache_frames`, each `read` advances the playback position by `speed` frames, which
+    can be fractional or negative to play the clip slower, faster or in reverse.
+
+    In threaded mode `frame_time` holds the capture time (`time.perf_counter`) of the last frame
+    returned by `read`, `frame_count` the number of frames captured so far and `dropped_frames`
+    the number of captured frames that were never returned by `read`.
     '''
-    def __init__(self, name=0, size=None, resize_mode='crop'):
+    def __init__(self, name=0, size=None, resize_mode='crop', threaded=False,
+                 interpolation='linear', num_buffers=2, cache_frames=False):
         ''' Constructor'''
         import cv2
         # define a video capture object
@@ -1239,103 +2371,937 @@ class VideoInput:
         self.size = size
         self.resize_mode = resize_mode
         self.name = name
+        self.threaded = threaded
+        if type(interpolation) == str:
+            interpolation = {'nearest': cv2.INTER_NEAREST,
+                             'linear': cv2.INTER_LINEAR,
+                             'cubic': cv2.INTER_CUBIC,
+                             'area': cv2.INTER_AREA,
+                             'lanczos': cv2.INTER_LANCZOS4}[interpolation]
+        self.interpolation = interpolation
+        self.frame_time = None
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self._last_read = 0
+        # Crop window for each source resolution
+        self._plans = {}
+        # Decoded frame, reused by the decoder when the resolution does not change
+        self._raw = None
+        self._buffers = []
+        self._num_buffers = max(num_buffers, 3) if threaded else max(num_buffers, 1)
+        self._next_buffer = 0
+        self.frames = None
+        self.position = 0.0
+        self.speed = 1.0
+        if cache_frames and type(name) == str:
+            self.frames = video_frame_cache.get(self)
+            if self.frames is not None:
+                # All frames are decoded, no need for the decoder or a capture thread anymore
+                self.vid.release()
+                self.threaded = threaded = False
+            else:
+                # Play back from the decoder
+                self.vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        if threaded:
+            import threading
+            # Only the capture thread uses the decoder once started
+            self._frame_total = int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT))
+            self._lock = threading.Lock()
+            self._frame_ready = threading.Condition(self._lock)
+            self._has_frame = threading.Event()
+            self._frame = None
+            self._frame_time = None
+            self._frame_index = None
+            self._seek_request = None
+            self._published = None
+            self._reading = None
+            self._running = True
+            self._thread = threading.Thread(target=self._capture, daemon=True)
+            self._thread.start()
+
+    @property
+    def num_frames(self):
+        ''' Number of frames in the clip (only known for cached frames, otherwise as reported by OpenCV)'''
+        if self.frames is not None:
+            return len(self.frames)
+        if self.threaded:
+            return self._frame_total
+        import cv2
+        return int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def frame(self, i):
+        ''' Returns frame `i` of the clip (wrapping around the clip length).
+        In threaded mode this waits for the capture thread to decode the frame'''
+        if self.frames is not None:
+            return self.frames[int(i) % len(self.frames)]
+        if not self.threaded:
+            self.seek(i)
+            return self.read()
+        i = int(i)
+        if self._frame_total > 0:
+            i %= self._frame_total
+        with self._lock:
+            self._seek_request = i
+            if self._frame_ready.wait_for(lambda: self._seek_request is None and self._frame_index == i, 5.0):
+                self._reading = self._published
+                return self._frame
+        return self._empty_frame()
+
+    def seek(self, i):
+        ''' Set the playback position to frame `i`'''
+        if self.frames is not None:
+            self.position = float(i) % len(self.frames)
+        elif self.threaded:
+            # The decoder is not thread safe, the capture thread performs the seek
+            with self._lock:
+                self._seek_request = int(i)
+        else:
+            import cv2
+            self.vid.set(cv2.CAP_PROP_POS_FRAMES, int(i))
 
     def read(self, loop_flag=False):
+        ''' Returns the next frame as an RGB uint8 array.
+        In threaded mode this returns the newest captured frame and only waits for the very first one'''
+        if self.frames is not None:
+            img = self.frames[int(self.position) % len(self.frames)]
+            self.position = (self.position + self.speed) % len(self.frames)
+            return img
+
+        if self.threaded:
+            self._has_frame.wait(5.0)
+            with self._lock:
+                img, frame_time, count = self._frame, self._frame_time, self.frame_count
+                self._reading = self._published
+            if img is None:
+                return self._empty_frame()
+            if count > self._last_read:
+                self.dropped_frames += count - self._last_read - 1
+                self._last_read = count
+            self.frame_time = frame_time
+            return img
+
+        img = self._read_frame(loop_flag)
+        if img is None:
+            return self._empty_frame()
+        i = self._next_buffer
+        self._next_buffer = (i + 1) % self._num_buffers
+        return self._process(img, i)
+
+    def close(self):
+        ''' Stops the capture thread (if any) and releases the video device or file'''
+        if self.threaded and self._running:
+            self._running = False
+            self._thread.join()
+        self.vid.release()
+
+    def _empty_frame(self):
+        print('No video')
+        if self.size is not None:
+            return np.zeros((self.size[1], self.size[0], 3)).astype(np.uint8)
+        else:
+            return np.zeros((16, 16, 3)).astype(np.uint8)
+
+    def _read_frame(self, loop_flag=False):
         import cv2
         # Capture video frame by frame
-        success, img = self.vid.read()
+        success, img = self.vid.read(self._raw)
 
         if not success:
             if type(self.name) == str and not loop_flag: # If a video loop automatically
                 self.vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                return self.read(True)
-            else:
-                print('No video')
-                if self.size is not None:
-                    return np.zeros((self.size[1], self.size[0], 3)).astype(np.uint8)
-                else:
-                    return np.zeros((16, 16, 3)).astype(np.uint8)
+                return self._read_frame(True)
+            return None
+        self._raw = img
+        return img
 
-        if self.size is not None:
-            src_w, src_h = img.shape[1], img.shape[0]
+    def _plan(self, src_w, src_h):
+        ''' Crop window (y0, y1, x0, x1) for frames of the given source size'''
+        plan = self._plans.get((src_w, src_h))
+        if plan is not None:
+            return plan
+        y0, y1, x0, x1 = 0, src_h, 0, src_w
+        if self.size is not None and self.resize_mode == 'crop':
+            # Keep aspect ratio by cropping
             dst_w, dst_h = self.size
+            aspect = dst_w / dst_h
+
+            # Check if aspect ratio match
+            asrc_w = int(aspect*src_h)
+            if asrc_w > src_w: # aspect ratio > 1
+                asrc_h = int(src_h/aspect)
+                y0 = (src_h - asrc_h)//2
+                y1 = y0 + asrc_h
+            elif asrc_w < src_w: # aspect ratio < 1
+                x0 = (src_w - asrc_w)//2
+                x1 = x0 + asrc_w
+        plan = (y0, y1, x0, x1)
+        self._plans[(src_w, src_h)] = plan
+        return plan
+
+    def _process(self, img, index):
+        ''' Crops, resizes and converts a BGR frame to RGB into output buffer `index`'''
+        import cv2
+        y0, y1, x0, x1 = self._plan(img.shape[1], img.shape[0])
+        img = img[y0:y1, x0:x1]
+        if self.size is not None:
+            shape = (self.size[1], self.size[0], 3)
+        else:
+            shape = img.shape
+        while len(self._buffers) <= index:
+            self._buffers.append(None)
+        out = self._buffers[index]
+        if out is None or out.shape != shape:
+            out = np.empty(shape, dtype=np.uint8)
+            self._buffers[index] = out
+
+        if self.size is not None:
+            # Resize the image frames and swap channels in place
+            cv2.resize(img, self.size, dst=out, interpolation=self.interpolation)
+            cv2.cvtColor(out, cv2.COLOR_BGR2RGB, dst=out)
+        else:
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=out)
+        return out
+
+    def _capture(self):
+        import cv2
+        import time
+        # Video files are paced at their own frame rate, cameras at the rate they deliver frames
+        interval = 0.0
+        if type(self.name) == str:
+            fps = self.vid.get(cv2.CAP_PROP_FPS)
+            if fps > 0:
+                interval = 1.0/fps
+        next_time = time.perf_counter()
+        while self._running:
+            with self._lock:
+                seek, self._seek_request = self._seek_request, None
+            if seek is not None:
+                self.vid.set(cv2.CAP_PROP_POS_FRAMES, seek)
+                next_time = time.perf_counter()
+            img = self._read_frame()
+            if img is None:
+                self._has_frame.set()
+                time.sleep(0.1)
+                continue
+            # Write into a buffer that is neither published nor being read
+            with self._lock:
+                busy = (self._published, self._reading)
+            index = self._next_buffer
+            while index in busy:
+                index = (index + 1) % self._num_buffers
+            self._next_buffer = (index + 1) % self._num_buffers
+            img = self._process(img, index)
+            frame_index = int(self.vid.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+            t = time.perf_counter()
+            with self._lock:
+                self._frame = img
+                self._published = index
+                self._frame_time = t
+                self._frame_index = frame_index
+                self.frame_count += 1
+                self._frame_ready.notify_all()
+            self._has_frame.set()
+            if interval:
+                next_time = max(next_time + interval, t - interval)
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+
+class VideoFrameCache:
+    ''' LRU cache of decoded video clips, bounded by a byte budget.
+    Each clip is decoded and resized once into a memory mapped temporary file, keyed on the
+    file path, modification time and size, and the frame size and resize settings of the `VideoInput`.
+    '''
+    def __init__(self, max_bytes=2*1024*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def get(self, video):
+        ''' Get the frames of a `VideoInput` file as a read-only (frames, height, width, 3) array,
+        decoding the whole clip if necessary. Returns None if no frame could be decoded,
+        or if the decoded clip would not fit in `max_bytes`'''
+        import os
+        path = os.path.abspath(video.name)
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size, video.size, video.resize_mode, video.interpolation)
+        frames = self.entries.get(key)
+        if frames is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return frames
+        self.misses += 1
+        frames = self._decode(video)
+        if frames is None:
+            return None
+        self.entries[key] = frames
+        self.nbytes += frames.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            k, f = self.entries.popitem(last=False)
+            self.nbytes -= f.nbytes
+        return frames
+
+    def _decode(self, video):
+        import cv2
+        import tempfile
+        video.vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        shape = None
+        count = 0
+        # The file is removed as soon as it is closed, the memory map keeps the data alive
+        with tempfile.TemporaryFile() as f:
+            while True:
+                success, img = video.vid.read(video._raw)
+                if not success:
+                    break
+                video._raw = img
+                img = video._process(img, 0)
+                if shape is None:
+                    shape = img.shape
+                elif img.shape != shape:
+                    break
+                if (count + 1)*img.nbytes > self.max_bytes:
+                    print('Video is too long to cache its frames, decoding it on playback')
+                    return None
+                f.write(img.data)
+                count += 1
+            if not count:
+                return None
+            f.flush()
+            return np.memmap(f, dtype=np.uint8, mode='r', shape=(count,) + shape)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+video_frame_cache = VideoFrameCache()
+
+class Layer(Canvas):
+    ''' An offscreen canvas composited onto another canvas, see `Canvas.create_layer`.
+    A layer can be drawn into like any other canvas. Static layers are only redrawn (with `draw`)
+    after `invalidate` is called, dynamic layers are cleared and redrawn each time they are composited.
+    When drawing into a layer directly (without a `draw` function), call `invalidate` after modifying it
+    so recording canvases pick up the change.
+    '''
+    def __init__(self, width, height, draw=None, static=True, blend='over', opacity=1.0):
+        super().__init__(width, height, background=(0.0, 0.0, 0.0, 0.0), recording=False)
+        self.draw_fn = draw
+        self.static = static
+        self.blend = blend
+        self.opacity = opacity
+        self.visible = True
+        self.needs_render = True
+        # Copy of the layer pixels recorded by the compositing canvas
+        self.snapshot = None
+
+    def invalidate(self):
+        ''' Redraw a static layer the next time it is composited'''
+        self.needs_render = True
+        self.snapshot = None
+
+    def render(self):
+        ''' Clear the layer and draw it with the layer `draw` function'''
+        self.clear()
+        self.push()
+        self.draw_fn(self)
+        self.pop()
+        self.needs_render = False
+        self.snapshot = None
+
+
+class AccumulationBuffer:
+    ''' A float32 copy of the canvas pixels used to accumulate frames, e.g. for trails, long exposure and feedback effects.
+    Values are in the 0-1 range (with the premultiplied BGRA layout of the canvas pixels), and are only
+    quantized when composited back into the canvas, so trails fade out smoothly and completely.
+    Get the buffer of a canvas with `Canvas.accumulation_buffer()`.
+
+    Example (trails):
+    ```
+    acc = c.accumulation_buffer()
+    # in draw:
+    c.background(0)
+    c.circle(x, y, 10)
+    acc.decay(0.95)  # fade previous frames
+    acc.add()        # add the current frame
+    acc.composite()  # replace the canvas pixels with the accumulated image
+    ```
+    '''
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.buffer = np.zeros((canvas.height, canvas.width, 4), dtype=np.float32)
+        self._tmp = np.empty_like(self.buffer)
+
+    def _pixels(self, weight=1.0):
+        # Canvas pixels scaled by weight, in the temporary buffer
+        return np.multiply(self.canvas._pixel_view(), weight/255, out=self._tmp)
+
+    def clear(self):
+        self.buffer[:] = 0
+
+    def decay(self, amount):
+        ''' Multiply the accumulated values by `amount` (e.g. 0.95 for slowly fading trails)'''
+        self.buffer *= amount
+
+    def add(self, weight=1.0):
+        ''' Add the current canvas pixels (multiplied by `weight`)'''
+        self.buffer += self._pixels(weight)
+
+    def maximum(self):
+        ''' Keep the maximum of the accumulated values and the canvas pixels (long exposure)'''
+        np.maximum(self.buffer, self._pixels(), out=self.buffer)
+
+    def blend(self, amount):
+        ''' Interpolate towards the current canvas pixels by `amount` (a running average)'''
+        pixels = self._pixels()
+        pixels -= self.buffer
+        pixels *= amount
+        self.buffer += pixels
+
+    def feedback(self, zoom=1.0, angle=0.0, offset=(0, 0), amount=1.0):
+        ''' Transform the accumulated image (scale by `zoom` and rotate by `angle` radians around the center,
+        then translate by `offset`) and multiply it by `amount`. Requires OpenCV'''
+        import cv2
+        h, w = self.buffer.shape[:2]
+        M = cv2.getRotationMatrix2D((w/2, h/2), degrees(angle), zoom)
+        M[:, 2] += offset
+        cv2.warpAffine(self.buffer, M, (w, h), dst=self._tmp, flags=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        np.multiply(self._tmp, amount, out=self.buffer)
+
+    def composite(self):
+        ''' Replace the canvas pixels with the accumulated image (clipped to the 0-1 range)'''
+        tmp = np.multiply(self.buffer, 255, out=self._tmp)
+        tmp += 0.5
+        np.clip(tmp, 0, 255, out=tmp)
+        np.copyto(self.canvas._pixel_view(), tmp, casting='unsafe')
+        self.canvas.update_pixels()
+
+
+class TiledCanvas(Canvas):
+    ''' A canvas for very large (e.g. print resolution) images that does not allocate the full image.
+    Drawing commands are recorded, and when saving the recording is replayed tile by tile
+    (each tile being rendered with a translated device offset, which clips it to the tile bounds).
+    Rows of tiles are streamed to a png file, so peak memory is bounded by a row of tiles.
+    Tiles in a row are rendered in parallel threads.
+
+    Only the vector operations (e.g. `save`, `save_async`, `save_svg`, `save_pdf`) are supported,
+    pixel access (`get_image`, `load_pixels`, accumulation buffers, `CanvasRecorder`...) and layers
+    are not available and raise a ValueError.
+
+    param width, height: size of the image in pixels
+    param tile_size: size (in pixels) of the square tiles
+    param threads: number of threads used to render the tiles (defaults to the number of CPUs)
+    Other arguments are passed to `Canvas`, except `recording`: drawing is always recorded.
+    '''
+    def __init__(self, width, height, background=(0.0, 0.0, 0.0, 255.0), tile_size=1024, threads=None, **kwargs):
+        self.tile_size = tile_size
+        self.threads = threads
+        self._initial_background = background
+        kwargs.pop('recording', None)
+        super().__init__(width, height, background=background, recording=True, **kwargs)
+
+    def _create_surface(self, width, height):
+        # Only used to keep track of the drawing state, drawing is replayed to the tiles
+        return cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+
+    def _render_tile(self, dl, x, y, w, h):
+        surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        surf.set_device_offset(-x, -y)
+        ctx = cairo.Context(surf)
+        ctx.set_source_rgba(*self._initial_background)
+        ctx.paint()
+        dl.replay(ctx)
+        surf.flush()
+        return np.ndarray(shape=(h, w, 4), dtype=np.uint8, buffer=surf.get_data(), strides=(surf.get_stride(), 4, 1))
 
-            if self.resize_mode == 'crop':
-                # Keep aspect ratio by cropping
-                aspect = dst_w / dst_h
+    def save_image(self, path):
+        ''' Render the canvas tile by tile to a png file'''
+        self._save_tiles(self.recorded_frames[-1], path)
+
+    def save_async(self, path, frame=-1):
+        ''' Save the canvas to a png, svg or pdf file on a background thread, see `Canvas.save_async`.
+        Png files are rendered tile by tile from a copy of the recorded frame'''
+        if '.svg' in path or '.pdf' in path:
+            return super().save_async(path, frame)
+        return self._submit_export(self._save_tiles, self._get_recorded_frame(frame).copy(), path)
+
+    def _save_tiles(self, dl, path):
+        from concurrent.futures import ThreadPoolExecutor
+        ts = self.tile_size
+        with ThreadPoolExecutor(self.threads) as pool, PNGWriter(path, self.width, self.height) as png:
+            for y in range(0, self.height, ts):
+                h = min(ts, self.height - y)
+                band = np.empty((h, self.width, 3), dtype=np.uint8)
+                tiles = [(x, min(ts, self.width - x)) for x in range(0, self.width, ts)]
+                futures = [pool.submit(self._render_tile, dl, x, y, w, h) for x, w in tiles]
+                for (x, w), future in zip(tiles, futures):
+                    band[:, x:x+w] = future.result()[:, :, 2::-1]
+                png.write_rows(band)
+
+    def get_image(self, *args, **kwargs):
+        raise ValueError('TiledCanvas does not keep the image in memory, pixel access is not available')
+
+    def _pixel_view(self):
+        raise ValueError('TiledCanvas does not keep the image in memory, pixel access is not available')
+
+    def create_layer(self, *args, **kwargs):
+        raise ValueError('TiledCanvas does not support layers, they require full size buffers')
+
+    def accumulation_buffer(self):
+        raise ValueError('TiledCanvas does not keep the image in memory, pixel access is not available')
+
+
+class PNGWriter:
+    ''' Writes an 8 bit RGB png file row by row, without keeping the whole image in memory'''
+    def __init__(self, path, width, height, compression=6):
+        import zlib
+        self.f = open(path, 'wb')
+        self.width = width
+        self.compressor = zlib.compressobj(compression)
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        import zlib
+        self.f.write(struct.pack('>I', len(data)) + kind + data +
+                     struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, rows):
+        ''' Write rows given as a uint8 array with shape `(n, width, 3)`'''
+        # Each row starts with its filter type (0, none)
+        data = np.zeros((len(rows), 1 + self.width*3), dtype=np.uint8)
+        data[:, 1:] = rows.reshape(len(rows), -1)
+        compressed = self.compressor.compress(data.tobytes())
+        if compressed:
+            self._chunk(b'IDAT', compressed)
+
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VideoWriter:
+    ''' Writes frames (uint8 BGRA arrays with shape `(height, width, 4)`, the cairo pixel layout) to a video file.
+    Uses an ffmpeg subprocess if ffmpeg is available, otherwise imageio (requires imageio and imageio-ffmpeg).
+
+    param path: output video file path
+    param width, height: frame size
+    param fps: frame rate of the video
+    param ffmpeg_args: list of additional output arguments for ffmpeg (e.g. `['-crf', '18']`)
+    '''
+    def __init__(self, path, width, height, fps=30, ffmpeg_args=None):
+        import shutil
+        self.proc = None
+        self.writer = None
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is not None:
+            import subprocess
+            cmd = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgra', '-s', '%dx%d'%(width, height), '-r', str(fps), '-i', '-',
+                   # yuv420p requires even dimensions
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+            cmd += list(ffmpeg_args or []) + [path]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        else:
+            import imageio
+            self.writer = imageio.get_writer(path, fps=fps)
 
-                # Check if aspect ratio match
-                asrc_w = int(aspect*src_h)
-                if asrc_w > src_w: # aspect ratio > 1
-                    asrc_h = int(src_h/aspect)
-                    d = (src_h - asrc_h)//2
-                    img = img[d:d+asrc_h, :, :]
-                elif asrc_w < src_w: # aspect ratio < 1
-                    d = (src_w - asrc_w)//2
-                    img = img[:, d:d+asrc_w, :]
+    def write(self, frame):
+        if self.proc is not None:
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+        else:
+            self.writer.append_data(frame[:, :, 2::-1])
 
-            # Resize the image frames
-            img = cv2.resize(img, self.size)
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        else:
+            self.writer.close()
+
+
+class CanvasRecorder:
+    ''' Records the frames of a canvas to a video file without slowing down drawing.
+    Each call to `add_frame` copies the canvas pixels into a preallocated ring of frames,
+    and a background thread sends the frames to the video encoder (see VideoWriter).
+
+    param canvas: the Canvas to record
+    param path: output video file path
+    param fps: frame rate of the video
+    param ring_size: number of frames that can be waiting to be encoded
+    param drop_frames: if True, frames are dropped (and counted in `dropped_frames`) when the encoder
+        cannot keep up, otherwise `add_frame` waits for a free frame
+    param ffmpeg_args: list of additional output arguments for ffmpeg
+
+    Example:
+    ```
+    rec = CanvasRecorder(c, 'out.mp4', fps=60)
+    # in draw, after drawing:
+    rec.add_frame()
+    # when done
+    rec.close()
+    ```
+    '''
+    def __init__(self, canvas, path, fps=30, ring_size=8, drop_frames=True, ffmpeg_args=None):
+        import queue
+        import threading
+        self.canvas = canvas
+        self.drop_frames = drop_frames
+        self.frames = [np.empty((canvas.height, canvas.width, 4), dtype=np.uint8) for i in range(ring_size)]
+        self.free = queue.Queue()
+        for i in range(ring_size):
+            self.free.put(i)
+        self.filled = queue.Queue()
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.writer = VideoWriter(path, canvas.width, canvas.height, fps, ffmpeg_args)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_frame(self):
+        ''' Capture the current canvas pixels, returns False if the frame was dropped'''
+        import queue
+        if self.error is not None:
+            raise self.error
+        try:
+            i = self.free.get(block=not self.drop_frames)
+        except queue.Empty:
+            self.dropped_frames += 1
+            return False
+        np.copyto(self.frames[i], self.canvas._pixel_view())
+        self.filled.put(i)
+        self.frame_count += 1
+        return True
+
+    def _run(self):
+        while True:
+            i = self.filled.get()
+            if i is None:
+                break
+            try:
+                if self.error is None:
+                    self.writer.write(self.frames[i])
+            except Exception as e:
+                self.error = e
+            self.free.put(i)
+
+    def close(self):
+        ''' Wait for the pending frames to be encoded and close the video file'''
+        if self.thread is None:
+            return
+        self.filled.put(None)
+        self.thread.join()
+        self.thread = None
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Per process state for render_frames
+_render_worker = {}
+
+def _init_render_worker(draw, width, height, canvas_args):
+    _render_worker['draw'] = draw
+    _render_worker['canvas'] = Canvas(width, height, recording=False, **canvas_args)
+
+def _render_frame(task):
+    frame, png_path = task
+    c = _render_worker['canvas']
+    # push/pop so that each frame starts from the same state
+    c.push()
+    _render_worker['draw'](c, frame)
+    c.pop()
+    if png_path is not None:
+        c.save_image(png_path)
+        return png_path
+    return np.array(c._pixel_view())
+
+def render_frames(draw, num_frames, width, height, path, fps=30, processes=None, chunksize=4, **canvas_args):
+    ''' Render an animation offline, distributing the frames to a pool of processes, each with its own Canvas.
+
+    param draw: a function `draw(canvas, frame_index)` that draws a frame. Each frame starts with the
+        canvas state (transform, colors) reset, but the pixels are those of the previous frame rendered by the same
+        process, so `draw` should clear the canvas. The function must be defined at the top level of a module
+        (or script) so that it can be sent to the worker processes
+    param num_frames: number of frames to render
+    param width, height: canvas size
+    param path: either a printf style pattern for a sequence of png files (e.g. `'frames/frame_%05d.png'`),
+        or the path of a video file (see VideoWriter)
+    param fps: frame rate, when writing a video
+    param processes: number of processes (defaults to the number of CPUs), with 1 frames are rendered
+        in the current process
+    param chunksize: number of consecutive frames sent to a process at once
+    Additional keyword arguments are passed to the Canvas constructor.
+
+    Returns the list of png files written, or the path of the video file
+    '''
+    import multiprocessing
+    png = '%' in path
+    tasks = [(i, path % i if png else None) for i in range(num_frames)]
+    writer = None if png else VideoWriter(path, width, height, fps)
+    results = []
+    def consume(res):
+        if png:
+            results.append(res)
+        else:
+            writer.write(res)
 
-        img = img[:,:,::-1]
-        return img
+    if processes == 1:
+        _init_render_worker(draw, width, height, canvas_args)
+        for task in tasks:
+            consume(_render_frame(task))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_render_worker,
+                                  initargs=(draw, width, height, canvas_args)) as pool:
+            # imap returns the frames in order
+            for res in pool.imap(_render_frame, tasks, chunksize=chunksize):
+                consume(res)
+    if writer is not None:
+        writer.close()
+        return path
+    return results
+
+
+def copy_context_state(src, dst):
+    ''' Copy the graphics state (transform, line style, font and source) of a cairo context to another'''
+    dst.set_matrix(src.get_matrix())
+    dst.set_line_width(src.get_line_width())
+    dst.set_line_cap(src.get_line_cap())
+    dst.set_line_join(src.get_line_join())
+    dst.set_miter_limit(src.get_miter_limit())
+    dst.set_dash(*src.get_dash())
+    dst.set_fill_rule(src.get_fill_rule())
+    dst.set_operator(src.get_operator())
+    dst.set_tolerance(src.get_tolerance())
+    dst.set_antialias(src.get_antialias())
+    dst.set_font_face(src.get_font_face())
+    dst.set_font_matrix(src.get_font_matrix())
+    dst.set_source(src.get_source())
+
+class TextLayoutCache:
+    ''' LRU cache of laid out text (glyph runs and extents), keyed on the font face, font size,
+    scale/rotation of the current transformation and string'''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ctx, text):
+        ''' Returns the glyphs (positioned at the origin) and the text extents of `text`,
+        for the current font of the cairo context `ctx`'''
+        face = ctx.get_font_face()
+        try:
+            face_key = (face.get_family(), face.get_slant(), face.get_weight())
+        except AttributeError: # Not a toy font face
+            face_key = face
+        # Glyph advances depend on the device scale when metrics are hinted, so the
+        # linear part of the transformation is part of the key (translation is not)
+        m = ctx.get_matrix()
+        key = (face_key, tuple(ctx.get_font_matrix()), (m.xx, m.yx, m.xy, m.yy), text)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        font = ctx.get_scaled_font()
+        entry = (font.text_to_glyphs(0, 0, text, False), ctx.text_extents(text))
+        self.entries[key] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+text_layout_cache = TextLayoutCache()
+
+def _glyphs_path(ctx, runs):
+    for x, y, glyphs in runs:
+        ctx.save()
+        ctx.translate(x, y)
+        ctx.glyph_path(glyphs)
+        ctx.restore()
+
+def _color_tuple(clr):
+    # Normalized color as an RGBA tuple (colors stored in the canvas state are immutable)
+    if clr is None or (type(clr) == tuple and len(clr) == 4):
+        return clr
+    clr = tuple(np.asarray(clr, dtype=float).tolist())
+    if len(clr) == 3:
+        clr = clr + (1.0,)
+    return clr
+
+def _color_args(clr):
+    # Single color given as a number, string or sequence, to arguments for fill/stroke
+    if is_number(clr) or isinstance(clr, str):
+        return (clr,)
+    return tuple(clr)
+
+def _as_points(points):
+    # Polyline points as a list of [x, y] pairs (iterating a list is much faster than a numpy array)
+    return np.asarray(points, dtype=float).reshape(-1, 2).tolist()
+
+def _polylines_path(ctx, polys, closed):
+    for P in polys:
+        ctx.new_sub_path()
+        ctx.move_to(*P[0])
+        line_to = ctx.line_to
+        for x, y in P[1:]:
+            line_to(x, y)
+        if closed:
+            ctx.close_path()
+
+def _circles_path(ctx, circles):
+    for x, y, r in circles:
+        ctx.new_sub_path()
+        ctx.arc(x, y, r, 0, pi*2)
+
+def _rects_path(ctx, rects):
+    for x, y, w, h in rects:
+        ctx.rectangle(x, y, w, h)
+
+def _segments_path(ctx, segments):
+    for x1, y1, x2, y2 in segments:
+        ctx.move_to(x1, y1)
+        ctx.line_to(x2, y2)
+
+def _points_path(ctx, points):
+    # Zero length segments, drawn as dots with round (or square) line caps
+    for x, y in points:
+        ctx.move_to(x, y)
+        ctx.line_to(x, y)
 
 def cardinal_spline(Q, c, closed=False):
     ''' Returns a Bezier chain for a Cardinal spline interpolation for a sequence of values
-    c is the tension parameter with 0.5 a Catmull-Rom spline
+    c is the tension parameter with 0.5 a Catmull-Rom spline.
+    The values are along the first axis of Q, e.g. an array with shape `(n, 2)` for `n` points,
+    or `(n, m, 2)` to interpolate `m` polylines with the same number of points at once
     '''
-    Q = np.array(Q)
+    Q = np.asarray(Q, dtype=float)
     if closed:
-        Q = np.vstack([Q, Q[0]])
+        Q = np.concatenate([Q, Q[:1]])
     n = len(Q)
-    D = []
-    for k in range(1, n-1):
-        # Note that we do not take parametrisation into account here
-        d = (1-c)*(Q[k+1] - Q[k-1])
-        D.append(d)
+    # Tangents, note that we do not take parametrisation into account here
+    D = np.empty_like(Q)
+    D[1:-1] = (1-c)*(Q[2:] - Q[:-2])
     if closed:
-        d1 =  (1-c)*(Q[1] - Q[-2])
-        dn = d1
+        D[0] = (1-c)*(Q[1] - Q[-2])
+        D[-1] = D[0]
     else:
-        d1 = (1-c)*(Q[1] - Q[0])
-        dn = (1-c)*(Q[-1] - Q[-2])
-    D = [d1] + D + [dn]
-    P = [Q[0]]
-    for k in range(1, n):
-        p1 = Q[k-1] + D[k-1]/3
-        p2 = Q[k] - D[k]/3
-        p3 = Q[k]
-        P += [p1, p2, p3]
-    return np.array(P)
-
-# Fix svg export clip path 
+        D[0] = (1-c)*(Q[1] - Q[0])
+        D[-1] = (1-c)*(Q[-1] - Q[-2])
+    P = np.empty((3*(n-1) + 1,) + Q.shape[1:])
+    P[0] = Q[0]
+    P[1::3] = Q[:-1] + D[:-1]/3
+    P[2::3] = Q[1:] - D[1:]/3
+    P[3::3] = Q[1:]
+    return P
+
+def cardinal_splines(poly_list, c, closed=False):
+    ''' Returns a list of Bezier chains interpolating each polyline in `poly_list` with a Cardinal spline.
+    Polylines with the same number of points are interpolated together'''
+    polys = [np.asarray(P, dtype=float) for P in poly_list]
+    res = [None]*len(polys)
+    by_length = {}
+    for i, P in enumerate(polys):
+        by_length.setdefault(P.shape, []).append(i)
+    for shape, indices in by_length.items():
+        if shape[0] < 2:
+            for i in indices:
+                res[i] = polys[i]
+            continue
+        # Interpolate with the polylines stacked along the second axis
+        Cp = cardinal_spline(np.stack([polys[i] for i in indices], axis=1), c, closed)
+        for j, i in enumerate(indices):
+            res[i] = Cp[:, j]
+    return res
+
+def _bezier_rows(Cp):
+    # Control points of a Bezier chain (without the first point) as rows of curve_to arguments
+    return np.asarray(Cp)[1:].reshape(-1, 6).tolist()
+
+def _curves_to(ctx, rows):
+    curve_to = ctx.curve_to
+    for row in rows:
+        curve_to(*row)
+
+def _lines_to(ctx, points):
+    line_to = ctx.line_to
+    for x, y in points:
+        line_to(x, y)
+
+def _bezier_path(ctx, chains, closed=False):
+    for start, rows in chains:
+        ctx.new_sub_path()
+        ctx.move_to(*start)
+        _curves_to(ctx, rows)
+        if closed:
+            ctx.close_path()
+
+def save_display_list(dl, path, width, height, kind='svg'):
+    ''' Replay a display list to a svg or pdf file'''
+    if kind == 'pdf':
+        surf = cairo.PDFSurface(path, width, height)
+        dl.replay(cairo.Context(surf))
+        surf.finish()
+        return
+    with open(path, 'wb') as f:
+        svg = SVGClipPathFilter(f)
+        surf = cairo.SVGSurface(svg, width, height)
+        dl.replay(cairo.Context(surf))
+        surf.finish()
+        svg.flush()
+
+# Fix svg export clip path
 # RecordingSurface adds a clip-path attribute that breaks Illustrator import
-def fix_namespace(xml_content):
-    #return xml_content
-    # Remove namespace prefixes from the XML content and replace ns1 with xlink (argh)
-    xml_content = xml_content.replace('ns0:', '').replace(':ns0', '')
-    return xml_content.replace('ns1:', 'xlink:').replace(':ns1', ':xlink')
+class SVGClipPathFilter:
+    ''' File-like object that removes the clip-path attribute of the first `<g>` element
+    of a SVG stream while it is written to the file `f` (a single streaming pass)'''
+    def __init__(self, f):
+        self.f = f
+        self.pending = b''
+        self.done = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.done:
+            return self.f.write(data)
+        self.pending += data
+        m = re.search(rb'<g[\s>/]', self.pending)
+        if m is not None:
+            end = self.pending.find(b'>', m.start())
+            if end >= 0:
+                tag = re.sub(rb'\s+clip-path="[^"]*"', b'', self.pending[m.start():end+1], count=1)
+                self.f.write(self.pending[:m.start()] + tag + self.pending[end+1:])
+                self.pending = b''
+                self.done = True
+        return len(data)
+
+    def flush(self):
+        if self.pending:
+            self.f.write(self.pending)
+            self.pending = b''
+        self.f.flush()
 
 def fix_clip_path(file_path, out_path):
-    import xml.etree.ElementTree as ET
-
-    # Load the SVG file
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    # Define the namespace
-    namespace = {'svg': 'http://www.w3.org/2000/svg'}
-
-    # Find the first <g> tag
-    g_tag = root.find('.//svg:g', namespace)
-
-    # Remove the 'clip-path' attribute if it exists
-    if 'clip-path' in g_tag.attrib:
-        del g_tag.attrib['clip-path']
-    res = ET.tostring(root, encoding='unicode')
-    # Save and then apply fixes
-    tree.write(out_path, encoding='UTF-8', xml_declaration=True, default_namespace='')
-    with open(out_path, 'r') as f:
-        # Fix namepace
-        txt = fix_namespace(f.read())
-    with open(out_path, 'w', encoding='utf-8') as f:
-        f.write(txt)
+    ''' Remove the clip-path attribute of the first `<g>` element in a SVG file'''
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    with open(out_path, 'wb') as f:
+        svg = SVGClipPathFilter(f)
+        svg.write(data)
+        svg.flush()
@@ -8,7 +8,7 @@ import cv2
 
 # Create video input
 w, h = 512, 512
-vid = canvas.VideoInput(size=(w, h))
+vid = canvas.VideoInput(size=(w, h), threaded=True)
 
 model_path = '../models/edges2comics/e100_generator.hd5'
 # Load pix2pix model